@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Measures the startup cost of executor, each time in a fresh interpreter: importing exectr, and
+# `executor --version`, compared to an interpreter which does nothing.
+#
+#   python benchmarks/bench_import.py --budget-ms 100 --out results.json
+#
+# Also checks that importing exectr does not load the modules only needed to display or execute a
+# script (pygments, pexpect). Exits with 1 if the median time of the import is over the budget, or
+# if one of those modules is loaded.
+# Results are printed as a table on stderr, and as JSON on stdout (or in --out).
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY_MODULES = ["pygments", "pexpect"]
+
+def run(args, n_runs):
+    # median wall time of a fresh interpreter running args
+    env = dict(os.environ, PYTHONPATH=REPO)
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable] + args, stdout=subprocess.DEVNULL, env=env)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def import_profile():
+    # cumulative import time of exectr as reported by python -X importtime, and the modules loaded
+    env = dict(os.environ, PYTHONPATH=REPO)
+    code = "import exectr, sys; print(' '.join(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    cumulative_us = None
+    for row in result.stderr.splitlines():
+        fields = [field.strip() for field in row.split("|")]
+        if len(fields) == 3 and fields[2] == "exectr":
+            cumulative_us = int(fields[1])
+    modules = result.stdout.split()
+    loaded = [name for name in LAZY_MODULES if name in modules]
+    return cumulative_us / 1e6, loaded
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=20, help="median of N interpreters")
+    parser.add_argument("--budget-ms", type=float, default=100.,
+                        help="maximum time importing exectr may add to the startup of python")
+    parser.add_argument("--out", default=None, help="write the JSON results to this file")
+    options = parser.parse_args()
+
+    python_s = run(["-c", "pass"], options.runs)
+    import_s = run(["-c", "import exectr"], options.runs) - python_s
+    version_s = run([os.path.join(REPO, "scripts", "executor"), "--version"], options.runs) - python_s
+    importtime_s, loaded = import_profile()
+    report = {
+        "python": sys.version.split()[0],
+        "date": datetime.now().isoformat(),
+        "python_startup_s": python_s,
+        "import_s": import_s,
+        "importtime_s": importtime_s,
+        "version_s": version_s,
+        "lazy_modules_loaded": loaded,
+        "budget_s": options.budget_ms / 1e3,
+    }
+    sys.stderr.write("python={:.1f}ms  +import exectr={:.1f}ms (importtime {:.1f}ms)  +executor --version={:.1f}ms  "
+                     "budget={:.0f}ms\n".format(python_s * 1e3, import_s * 1e3, importtime_s * 1e3, version_s * 1e3,
+                                                options.budget_ms))
+    if options.out is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(options.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if loaded:
+        sys.stderr.write("importing exectr loads {}\n".format(", ".join(loaded)))
+        sys.exit(1)
+    if import_s > options.budget_ms / 1e3:
+        sys.stderr.write("importing exectr is over budget\n")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# Measures what the executor itself costs per script line, on generated scripts of no-op (:) lines.
+#
+#   python benchmarks/bench_overhead.py --sizes 1000 10000 100000 --out results.json
+#
+# For each topology and size, reports the per-line time spent parsing, scheduling, locking (alone,
+# and with --lock-processes processes competing for the lock), writing the state, rendering and in
+# the pexpect round trip, then the per-line wall time of complete single-worker and --parallel runs
+# (up to --e2e-max lines). Those runs are traced (--trace): where their time went, summed over the
+# workers, is reported per line as well (run_single_lock_s, run_parallel_exec_s, ...).
+# Results are printed as a table on stderr, and as JSON on stdout (or in --out).
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import exectr  # noqa
+
+TOPOLOGIES = ["chain", "fanout", "diamond", "mixed"]
+
+def chain(n):
+    return ["# executor set-dependent"] + [":"] * (n - 1)
+
+def fanout(n):
+    # one origin, every other line only depends on it
+    lines = ["# executor tag origin", ":"]
+    while len(lines) < n:
+        lines.extend(["# executor if origin", ":"])
+    return lines[:n]
+
+def diamond_block(start, width):
+    # origin -> width branches -> join. start: line number of the first line of the block
+    lines = ["# executor set-independent", "# executor tag o{}".format(start), ":"]
+    origin = start + 2
+    branches = []
+    for _ in range(width):
+        lines.extend(["# executor if {}".format(origin), ":"])
+        branches.append(start + len(lines) - 1)
+    # fan-in: each directive line depends on its predecessor and on one branch
+    lines.append("# executor set-dependent")
+    for branch in branches:
+        lines.append("# executor if {}".format(branch))
+    lines.append(":")
+    return lines
+
+def diamond(n, width=4):
+    lines = []
+    while len(lines) < n:
+        lines.extend(diamond_block(len(lines) + 1, width))
+    return lines
+
+def mixed(n, seed=0):
+    # chains, fan-outs and diamonds, with tags and ifs pointing back to earlier blocks
+    rng = random.Random(seed)
+    lines = []
+    tags = []
+    while len(lines) < n:
+        kind = rng.choice(["chain", "fanout", "diamond", "if"])
+        if kind == "chain":
+            lines.extend(["# executor set-independent", "# executor set-dependent"])
+            lines.extend([":"] * rng.randint(2, 20))
+        elif kind == "fanout":
+            tag = "t{}".format(len(lines))
+            lines.extend(["# executor set-independent", "# executor tag {}".format(tag), ":"])
+            tags.append(tag)
+            for _ in range(rng.randint(2, 20)):
+                lines.extend(["# executor if {}".format(tag), ":"])
+        elif kind == "diamond":
+            lines.extend(diamond_block(len(lines) + 1, rng.randint(2, 8)))
+        elif tags:
+            lines.extend(["# executor set-independent", "# executor if {}".format(rng.choice(tags)), ":"])
+    return lines
+
+def generate_script(path, topology, n):
+    lines = globals()[topology](n)
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return len(lines)
+
+class NullTTY(object):
+    # a terminal which discards everything
+    def isatty(self):
+        return True
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def bench_parse(path):
+    return timed(exectr.initialize_state, path)
+
+def bench_scheduling(state):
+    def schedule():
+        scheduler = exectr.Scheduler(state)
+        while True:
+            line = scheduler.pop()
+            if line is None:
+                break
+            line.status = exectr.St.SUCCEEDED
+            scheduler.finish(line)
+    return timed(schedule)[0]
+
+def bench_lock(path, n):
+    # a sequential worker locks twice per line, nobody else wants the lock
+    workeruid = (os.getpid(), time.time())
+    def cycles():
+        for _ in range(2 * n):
+            exectr.lock(path, workeruid)
+            exectr.unlock(path, workeruid)
+    return timed(cycles)[0]
+
+LOCK_WORKER = """
+import os, sys, time
+import exectr
+workeruid = (os.getpid(), time.time())
+print("ready", flush=True)
+sys.stdin.read()
+for _ in range({cycles}):
+    exectr.lock({path!r}, workeruid)
+    exectr.unlock({path!r}, workeruid)
+"""
+
+def bench_lock_contended(path, n, n_processes):
+    # n_processes workers lock twice per line each, all at the same time. Wall time until they are
+    # all done, including the waits for each other
+    code = LOCK_WORKER.format(cycles=2 * n, path=path)
+    env = dict(os.environ, PYTHONPATH=REPO)
+    workers = [subprocess.Popen([sys.executable, "-c", code], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                env=env) for _ in range(n_processes)]
+    for worker in workers: # imported, then they start together
+        worker.stdout.readline()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.stdin.close()
+    for worker in workers:
+        if worker.wait() != 0:
+            raise RuntimeError("lock worker failed for {}".format(path))
+        worker.stdout.close()
+    return time.perf_counter() - start
+
+def bench_write_state(journal, state):
+    # one record when a line starts, one when it ends, compacting as the executor does
+    workeruid = (os.getpid(), time.time())
+    journal.compact(state, workeruid)
+    def transitions():
+        for line in state:
+            line.status = exectr.St.EXECUTING
+            journal.claim(line, workeruid)
+            line.status = exectr.St.SUCCEEDED
+            journal.append([line], workeruid)
+    return timed(transitions)[0]
+
+def bench_render(state):
+    setup_s, renderer = timed(exectr.Renderer, state, datetime.now(), None, False, 0., NullTTY())
+    def updates():
+        for line in state:
+            line.status = exectr.St.EXECUTING
+            renderer.update([line])
+            renderer.draw(force=True)
+            line.status = exectr.St.SUCCEEDED
+            renderer.update([line])
+    return setup_s, timed(updates)[0]
+
+def bench_roundtrip(tmpdir, n_samples):
+    workeruid = (os.getpid(), time.time())
+    sink = exectr.OutputSink(os.path.join(tmpdir, "roundtrip.sh"), workeruid)
+    ishell = exectr.spawn_shell(sink=sink)
+    try:
+        line = exectr.Line(1, ":", ":")
+        def roundtrips():
+            for _ in range(n_samples):
+                exectr.execute_line(line, ishell, sink)
+        return timed(roundtrips)[0] / n_samples
+    finally:
+        ishell.close()
+
+TRACED_SPANS = ["lock", "state", "deps", "exec"]
+
+def trace_totals(path):
+    # seconds per span name, summed over the workers. Each process exports the trace when it
+    # ends: merge again once all of them did
+    exectr.export_trace(path)
+    totals = dict.fromkeys(TRACED_SPANS, 0.)
+    with open(path + ".executor.trace.csv", newline='') as f:
+        for row in csv.DictReader(f):
+            if row["span"] in totals:
+                totals[row["span"]] += float(row["duration_s"])
+    return totals
+
+def bench_run(path, n_workers):
+    # complete run(s) of the script, in separate processes like a user would. Returns the wall
+    # time and the trace totals
+    for leftover in os.listdir(os.path.dirname(path)):
+        if leftover.startswith(os.path.basename(path) + ".executor"):
+            target = os.path.join(os.path.dirname(path), leftover)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            else:
+                os.remove(target)
+    code = "import exectr; exectr.main({!r}, plain=True, parallel={}, trace=True)".format(path, n_workers > 1)
+    env = dict(os.environ, PYTHONPATH=REPO)
+    start = time.perf_counter()
+    workers = [subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.DEVNULL, env=env)
+               for _ in range(n_workers)]
+    for worker in workers:
+        if worker.wait() != 0:
+            raise RuntimeError("executor run failed for {}".format(path))
+    return time.perf_counter() - start, trace_totals(path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--topologies", nargs="+", default=TOPOLOGIES, choices=TOPOLOGIES)
+    parser.add_argument("--e2e-max", type=int, default=1000,
+                        help="largest script for which complete runs are timed")
+    parser.add_argument("--parallel", type=int, default=2, help="number of --parallel workers")
+    parser.add_argument("--lock-processes", type=int, default=4,
+                        help="number of processes competing for the lock")
+    parser.add_argument("--roundtrip-samples", type=int, default=200)
+    parser.add_argument("--out", default=None, help="write the JSON results to this file")
+    options = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="executor_bench_")
+    results = []
+    try:
+        roundtrip_s = bench_roundtrip(tmpdir, options.roundtrip_samples)
+        for topology in options.topologies:
+            for size in options.sizes:
+                path = os.path.join(tmpdir, "{}_{}.sh".format(topology, size))
+                generate_script(path, topology, size)
+                parse_s, state = bench_parse(path)
+                n = len(state)
+                n_commands = len([line for line in state if not exectr.is_noop(line.command)])
+                result = {
+                    "topology": topology,
+                    "lines": n,
+                    "commands": n_commands,
+                    "parse_s": parse_s / n,
+                    "scheduling_s": bench_scheduling(exectr.initialize_state(path)) / n,
+                    "lock_uncontended_s": bench_lock(path, min(n, 10000)) / min(n, 10000),
+                    # per line executed by any of the processes
+                    "lock_contended_s": bench_lock_contended(path, min(n, 10000), options.lock_processes)
+                                        / (min(n, 10000) * options.lock_processes),
+                    "lock_processes": options.lock_processes,
+                    "write_state_s": bench_write_state(exectr.Journal(path), exectr.initialize_state(path)) / n,
+                    "write_state_sqlite_s": bench_write_state(exectr.SqliteStore(path),
+                                                              exectr.initialize_state(path)) / n,
+                    "roundtrip_s": roundtrip_s,
+                }
+                render_setup_s, render_s = bench_render(exectr.initialize_state(path))
+                result["render_setup_s"] = render_setup_s
+                result["render_s"] = render_s / n
+                if n <= options.e2e_max:
+                    for run, n_workers in [("run_single", 1), ("run_parallel", options.parallel)]:
+                        wall_s, totals = bench_run(path, n_workers)
+                        result[run + "_s"] = wall_s / n
+                        for span in TRACED_SPANS:
+                            result["{}_{}_s".format(run, span)] = totals[span] / n
+                    result["parallel_workers"] = options.parallel
+                results.append(result)
+                sys.stderr.write(format_result(result) + "\n")
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report = {
+        "exectr_version": exectr.__version__,
+        "python": sys.version.split()[0],
+        "date": datetime.now().isoformat(),
+        "unit": "seconds per line",
+        "results": results,
+    }
+    if options.out is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(options.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def format_result(result):
+    keys = ["parse_s", "scheduling_s", "lock_uncontended_s", "lock_contended_s", "write_state_s",
+            "write_state_sqlite_s", "render_s", "roundtrip_s"]
+    for run in ["run_single", "run_parallel"]:
+        keys.extend([run + "_s"] + ["{}_{}_s".format(run, span) for span in TRACED_SPANS])
+    cells = ["{}={:.1f}us".format(key[:-2], result[key] * 1e6) for key in keys if key in result]
+    return "{:>8} {:>7} lines  {}".format(result["topology"], result["lines"], "  ".join(cells))
+
+if __name__ == '__main__':
+    main()
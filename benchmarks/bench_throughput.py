@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Measures how fast the output of a command goes through execute_line, i.e. from the shell to the
+# line's output file, for commands which print a lot.
+#
+#   python benchmarks/bench_throughput.py --sizes-mb 1 10 100 --out results.json
+#
+# For each size, a command prints that many bytes of base64 text (76 bytes per line), and the
+# time of execute_line is compared to the time the same command takes with its output sent to
+# /dev/null. Also reports the round trip of a command which prints nothing.
+# Results are printed as a table on stderr, and as JSON on stdout (or in --out).
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import exectr  # noqa
+
+def producer(n_bytes):
+    return "head -c {} /dev/zero | base64".format(n_bytes * 57 // 77)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def bench_execute_line(tmpdir, n_bytes, repeat, with_sink=True):
+    workeruid = (os.getpid(), time.time())
+    sink = exectr.OutputSink(os.path.join(tmpdir, "throughput.sh"), workeruid) if with_sink else None
+    ishell = exectr.spawn_shell(sink=sink)
+    try:
+        line = exectr.Line(1, producer(n_bytes), producer(n_bytes))
+        best = None
+        for _ in range(repeat):
+            elapsed, (retcode, output) = timed(exectr.execute_line, line, ishell, sink)
+            if retcode != 0:
+                raise RuntimeError("{} failed".format(line.command))
+            best = elapsed if best is None else min(best, elapsed)
+        received = line.output_bytes if with_sink else len(output)
+        return best, received
+    finally:
+        ishell.close()
+
+def bench_baseline(n_bytes, repeat):
+    # the producer alone, without a terminal in between
+    best = None
+    for _ in range(repeat):
+        elapsed, _ = timed(lambda: subprocess.check_call(producer(n_bytes) + " > /dev/null", shell=True))
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_roundtrip(tmpdir, n_samples):
+    workeruid = (os.getpid(), time.time())
+    sink = exectr.OutputSink(os.path.join(tmpdir, "roundtrip.sh"), workeruid)
+    ishell = exectr.spawn_shell(sink=sink)
+    try:
+        line = exectr.Line(1, "true", "true")
+        def roundtrips():
+            for _ in range(n_samples):
+                exectr.execute_line(line, ishell, sink)
+        return timed(roundtrips)[0] / n_samples
+    finally:
+        ishell.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3, help="best of N executions")
+    parser.add_argument("--roundtrip-samples", type=int, default=200)
+    parser.add_argument("--out", default=None, help="write the JSON results to this file")
+    options = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="executor_bench_")
+    results = []
+    try:
+        roundtrip_s = bench_roundtrip(tmpdir, options.roundtrip_samples)
+        sys.stderr.write("roundtrip={:.2f}ms\n".format(roundtrip_s * 1e3))
+        for size_mb in options.sizes_mb:
+            n_bytes = int(size_mb * 1e6)
+            sink_s, received = bench_execute_line(tmpdir, n_bytes, options.repeat)
+            no_sink_s, _ = bench_execute_line(tmpdir, n_bytes, options.repeat, with_sink=False)
+            baseline_s = bench_baseline(n_bytes, options.repeat)
+            result = {
+                "bytes": received,
+                "execute_line_s": sink_s,
+                "execute_line_mb_s": received / sink_s / 1e6,
+                "no_sink_s": no_sink_s,
+                "no_sink_mb_s": received / no_sink_s / 1e6,
+                "baseline_s": baseline_s,
+            }
+            results.append(result)
+            sys.stderr.write(format_result(result) + "\n")
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report = {
+        "exectr_version": exectr.__version__,
+        "python": sys.version.split()[0],
+        "date": datetime.now().isoformat(),
+        "roundtrip_s": roundtrip_s,
+        "results": results,
+    }
+    if options.out is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(options.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def format_result(result):
+    return "{:>10.1f}MB  execute_line={:.1f}MB/s  no_sink={:.1f}MB/s  producer alone={:.3f}s".format(
+        result["bytes"] / 1e6, result["execute_line_mb_s"], result["no_sink_mb_s"], result["baseline_s"])
+
+if __name__ == '__main__':
+    main()
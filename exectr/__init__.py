@@ -1,12 +1,20 @@
+import bisect
+import fcntl
+import gc
+import hashlib
+import heapq
+import json
 import os
 import pickle
-import pexpect
+import queue
+import re
+import shutil
+import sys
+import threading
 import time
-from datetime import datetime
+from array import array
+from datetime import datetime, timedelta
 from enum import Enum
-from pygments import highlight
-from pygments.lexers import BashLexer
-from pygments.formatters import TerminalFormatter
 
 DEBUG = False
 
@@ -36,7 +44,6 @@ __version__ = '0.0.5'
 # add reason for skip to state?
 
 def print_version():
-    import shutil
     tsize = shutil.get_terminal_size((80, 20))
     if tsize[0] > 69:
         print("""
@@ -82,26 +89,48 @@ def as_symbol(st):
         raise ValueError
 
 class Line(object):
-    idx = None
-    command = None
-    origtext = None
-    status = St.UNTREATED
-    dependencies = None
-    retcode = None
-    output = None
-    dbginfo = None
-    tag = None
-    executedby = None # or skippedby
-    starttime = None
-    endtime = None
-    always = "no"
+    # slots instead of a __dict__ per line: machine generated scripts have millions of lines
+    __slots__ = ["idx", "command", "origtext", "status", "dependencies", "retcode", "output", "output_bytes",
+                 "output_path", "log_offset", "dbginfo", "tag", "executedby", "starttime", "endtime", "always",
+                 "inputs", "outputs", "resources", "foreach", "items", "source", "item", "uptodate", "attempts"]
 
     def __init__(self, idx, command, origtext):
         self.idx = idx
         self.command = command
         self.origtext = origtext
+        self.status = St.UNTREATED
         self.dependencies = []
-        self.executedby = []
+        self.retcode = None
+        self.output = None # last OUTPUT_TAIL_SIZE bytes, the full output is in output_path
+        self.output_bytes = 0
+        self.output_path = None
+        self.log_offset = None # where the output starts in the combined log
+        self.dbginfo = None
+        self.tag = None
+        self.executedby = [] # or skippedby
+        self.starttime = None
+        self.endtime = None
+        self.always = "no"
+        self.inputs = None # paths from inputs / outputs directives
+        self.outputs = None
+        self.resources = None # from the resources directive, e.g. {"cpu": 4., "mem": 8589934592.}
+        self.foreach = None # (variable, values) from the foreach directive, until the line is expanded
+        self.items = None # foreach: idx of the lines the line was expanded into, the line itself waits for them
+        self.source = None # foreach: idx of the line this line is an item of
+        self.item = None # foreach: value of the variable
+        self.uptodate = False # succeeded without running, see Fingerprints
+        self.attempts = 0 # executions since the line was last queued, see Leases.reclaim
+
+    def __getstate__(self):
+        return tuple([getattr(self, name) for name in Line.__slots__])
+
+    def __setstate__(self, state):
+        # a tuple in slot order, or the __dict__ of a Line pickled before slots
+        self.__init__(None, None, None)
+        if isinstance(state, dict):
+            state = [state.get(name, getattr(self, name)) for name in Line.__slots__]
+        for name, value in zip(Line.__slots__, state):
+            setattr(self, name, value)
 
     def copy_exec_info(self, line):
         assert line.idx == self.idx
@@ -110,31 +139,438 @@ class Line(object):
         self.status = line.status
         self.retcode = line.retcode
         self.output = line.output
+        self.output_bytes = line.output_bytes
+        self.output_path = line.output_path
+        self.log_offset = line.log_offset
+        self.executedby = line.executedby
+        self.attempts = line.attempts
+        self.starttime = line.starttime
+        self.endtime = line.endtime
+
+    def carry_exec_info(self, line):
+        # from the same line in a previous version of the script (see migrate_state)
+        self.status = line.status
+        self.retcode = line.retcode
+        self.output = line.output
+        self.output_bytes = line.output_bytes
+        self.output_path = line.output_path
+        self.log_offset = line.log_offset
         self.executedby = line.executedby
+        self.attempts = line.attempts
+        self.starttime = line.starttime
+        self.endtime = line.endtime
+        self.uptodate = line.uptodate
+
+    def start(self, workeruid):
+        if self.status in FINAL_STATUSES: # an always line, which runs again
+            self.attempts = 0
+        self.status = St.EXECUTING
+        self.executedby.append(workeruid)
+        self.attempts += 1
+
+    def requeue(self):
+        # back to untreated, with all its retries ahead of it
+        self.status = St.UNTREATED
+        self.attempts = 0
 
     def __repr__(self):
         return '<Line {} {} {} {} {} {} {} {} {}>'.format(
             self.idx, self.status, self.tag, self.dependencies, self.always,
             self.command, self.retcode, self.output, self.dbginfo)
 
-def pretty_print(state, workeruid=None):
-    print("")
+def highlight_rows(state):
+    # pygments takes longer to import than the rest of executor: only when the script is displayed
+    from pygments import highlight
+    from pygments.lexers import BashLexer
+    from pygments.formatters import TerminalFormatter
     human_lines = "\n".join([line.origtext for line in state])
-    hl_human_lines = highlight(human_lines, BashLexer(), TerminalFormatter())
-    for hl_linetext, line in zip(hl_human_lines.split("\n"), state):
-        symbol = as_symbol(line.status)
+    return highlight(human_lines, BashLexer(), TerminalFormatter()).split("\n")
+
+def foreach_counts(state):
+    # idx of each foreach line -> number of its items in each status
+    counts = {}
+    for line in state:
+        if line.source is not None:
+            counts.setdefault(line.source, {st: 0 for st in St})[line.status] += 1
+    return counts
+
+def foreach_status(line, counts):
+    # the row of a foreach line is executing while one of its items is
+    if counts[St.EXECUTING]:
+        return St.EXECUTING
+    if counts[St.FAILED]:
+        return St.FAILED
+    return line.status
+
+def format_counts(counts):
+    shown = ["{} {}".format(as_symbol(st).strip(), counts[st])
+             for st in [St.SUCCEEDED, St.FAILED, St.SKIPPED, St.EXECUTING] if counts[st]]
+    return "[{} items{}]".format(sum(counts.values()), "".join(["  " + text for text in shown]))
+
+def format_row(line, text, workeruid=None, counts=None):
+    # counts: for a foreach line, the one row of all of its items
+    symbol = as_symbol(line.status if counts is None else foreach_status(line, counts))
+    if workeruid is not None:
+        if counts is None and workeruid not in line.executedby and line.status != St.UNTREATED:
+            symbol = "(" + symbol + ")"
+        else:
+            symbol = " " + symbol + " "
+    idx = line.idx
+    if counts is not None:
+        text = "{} {}".format(format_counts(counts), text)
+    elif line.command is None:
+        idx = "   "
+        symbol = "  "
         if workeruid is not None:
-            if workeruid not in line.executedby and line.status != St.UNTREATED:
-                symbol = "(" + symbol + ")"
+            symbol = " " + symbol + " "
+    return '{} {:>3} {}'.format(symbol, idx, text)
+
+def pretty_print(state, workeruid=None, plain=False):
+    print("")
+    rows = [line for line in state if line.source is None]
+    counts = foreach_counts(state)
+    if plain or not sys.stdout.isatty():
+        texts = [line.origtext for line in rows]
+    else:
+        texts = highlight_rows(rows)
+    for hl_linetext, line in zip(texts, rows):
+        print(format_row(line, hl_linetext, workeruid, counts.get(line.idx)))
+
+class Renderer(object):
+    # displays the state during execution. The script is highlighted once, then only the rows
+    # whose status changed are redrawn (in a window around the active lines, at most every
+    # refresh_s). When not writing to a terminal, or if plain, status changes are appended
+    # instead, one per row and without colors. The items of a foreach line share its row.
+    # If quiet, only messages and the final counts are shown. label (e.g. the script's name) starts
+    # the rows which are appended. Status changes are also passed on to progress (see Progress).
+    def __init__(self, state, start_t, workeruid=None, plain=False, refresh_s=0.1, stream=None, quiet=False,
+                 label=None, progress=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.quiet = quiet
+        self.label = "" if label is None else label + " "
+        self.plain = plain or quiet or not self.stream.isatty()
+        self.start_t = start_t
+        self.workeruid = workeruid
+        self.refresh_s = refresh_s
+        self.mutex = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.rows = None
+        self.last_draw = 0.
+        self.progress = progress
+        self.set_state(state)
+
+    def set_state(self, state):
+        # (re)index the state, e.g. after it was reloaded from disk
+        with self.mutex:
+            self.state = state
+            self.visible = [line for line in state if line.source is None]
+            self.positions = {line.idx: pos for pos, line in enumerate(self.visible)}
+            for line in state:
+                if line.source is not None:
+                    self.positions[line.idx] = self.positions[line.source]
+            if self.rows is None and not self.plain:
+                self.rows = highlight_rows(self.visible)
+            self.shown = [line.status for line in self.visible]
+            self.items_shown = {line.idx: line.status for line in state if line.source is not None}
+            self.group_counts = foreach_counts(state)
+            self.counts = {st: 0 for st in St}
+            for line in state:
+                self.counts[line.status] += 1
+            self.executing = set()
+            for pos, line in enumerate(self.visible):
+                counts = self.group_counts.get(line.idx)
+                if line.status == St.EXECUTING or (counts is not None and counts[St.EXECUTING]):
+                    self.executing.add(pos)
+            self.first_untreated = 0
+            self.frame_start = None
+            self.frame_height = 0
+            self.dirty = set()
+            if self.progress is not None:
+                self.progress.set_state(state)
+
+    def update(self, lines):
+        with self.mutex:
+            for line in lines:
+                pos = self.positions[line.idx]
+                if line.source is None:
+                    previous = self.shown[pos]
+                    self.shown[pos] = line.status
+                    executing = line.status == St.EXECUTING
+                else:
+                    previous = self.items_shown[line.idx]
+                    self.items_shown[line.idx] = line.status
+                    group = self.group_counts[line.source]
+                    group[previous] -= 1
+                    group[line.status] += 1
+                    executing = group[St.EXECUTING] > 0
+                self.counts[previous] -= 1
+                self.counts[line.status] += 1
+                if executing:
+                    self.executing.add(pos)
+                else:
+                    self.executing.discard(pos)
+                if line.status == St.UNTREATED:
+                    self.first_untreated = min(self.first_untreated, pos)
+                if self.quiet:
+                    pass
+                elif self.plain:
+                    if not is_noop(line.command) or line.status == St.SKIPPED:
+                        self.stream.write("[{}] {}{} {:>3} {}{}\n".format(
+                            self.elapsed(), self.label, as_symbol(line.status), line.idx,
+                            line.origtext if line.source is None else line.command,
+                            " (up to date)" if line.uptodate else ""))
+                else:
+                    self.dirty.add(pos)
+            if self.plain:
+                self.stream.flush()
+            if self.progress is not None:
+                self.progress.update(lines)
+
+    def elapsed(self):
+        return str(datetime.now() - self.start_t).split(".")[0]
+
+    def header(self):
+        counts = ["{} {}".format(as_symbol(st).strip(), self.counts[st])
+                  for st in [St.SUCCEEDED, St.FAILED, St.SKIPPED, St.EXECUTING]]
+        return "EXECUTING ({})  {}  / {}".format(self.elapsed(), "  ".join(counts), len(self.state))
+
+    def window_start(self, height):
+        # keep the first executing (or untreated) line in view, move by whole pages
+        n_rows = len(self.visible)
+        if n_rows <= height:
+            return 0
+        while self.first_untreated < n_rows - 1 and self.shown[self.first_untreated] != St.UNTREATED:
+            self.first_untreated += 1
+        anchor = min(self.executing) if self.executing else self.first_untreated
+        start = self.frame_start or 0
+        if anchor < start or anchor >= start + height - 2:
+            start = max(0, min(anchor - 2, n_rows - height))
+        return start
+
+    def row(self, pos):
+        line = self.visible[pos]
+        return format_row(line, self.rows[pos], self.workeruid, self.group_counts.get(line.idx))
+
+    def draw(self, force=False):
+        if self.plain:
+            return
+        with self.mutex:
+            now = time.time()
+            if not force and now - self.last_draw < self.refresh_s:
+                return
+            self.last_draw = now
+            height = max(5, shutil.get_terminal_size((80, 20))[1] - 3)
+            start = self.window_start(height)
+            out = []
+            if start != self.frame_start or self.frame_height == 0:
+                if self.frame_height:
+                    out.append("\x1b[{}A".format(self.frame_height))
+                frame = [self.header(), "---------"]
+                frame.extend([self.row(pos) for pos in range(start, min(start + height, len(self.visible)))])
+                out.append("\r" + "".join([row + "\x1b[K\n" for row in frame]) + "\x1b[J")
+                self.frame_start = start
+                self.frame_height = len(frame)
             else:
-                symbol = " " + symbol + " "
-        idx = line.idx
-        if line.command is None:
-            idx = "   "
-            symbol = "  "
-            if workeruid is not None:
-                symbol = " " + symbol + " "
-        print('{} {:>3} {}'.format(symbol, idx, hl_linetext))
+                # cursor sits right below the frame: go up to each row which changed, and back
+                redraws = [(0, self.header())]
+                redraws.extend([(2 + pos - start, self.row(pos)) for pos in sorted(self.dirty)
+                                if start <= pos < start + height])
+                for offset, row in redraws:
+                    up = self.frame_height - offset
+                    out.append("\x1b[{}A\r{}\x1b[K\x1b[{}B\r".format(up, row, up))
+            self.dirty.clear()
+            # no line wrapping, otherwise rows would not match terminal lines
+            self.stream.write("\x1b[?7l" + "".join(out) + "\x1b[?7h")
+            self.stream.flush()
+
+    def message(self, text):
+        with self.mutex:
+            self.stream.write(self.label + text + "\n")
+            self.stream.flush()
+            self.frame_height = 0 # the next frame is drawn below the message
+
+    def start(self):
+        if self.progress is not None:
+            self.progress.start()
+        if self.plain:
+            return
+        def refresh():
+            while not self.stopped.wait(self.refresh_s):
+                self.draw()
+        self.draw(force=True)
+        self.thread = threading.Thread(target=refresh)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.plain:
+            self.message(self.header().replace("EXECUTING", "EXECUTED", 1))
+        else:
+            self.draw(force=True)
+        if self.progress is not None:
+            self.progress.close()
+
+class Progress(object):
+    # machine readable progress, so that monitoring does not need to read the state: counts per
+    # status, lines per second, the line each worker executes, lock waits, and the time left
+    # estimated from the durations of previous runs. Written to <script>.executor.status.json and,
+    # with a metrics_dir, in the Prometheus textfile format to <metrics_dir>/<script>.prom.
+    # Status changes only update counters, a thread replaces the files at most every interval_s.
+    interval_s = 1.
+
+    def __init__(self, path, start_t, estimate=None, n_workers=1, metrics_dir=None):
+        self.path = path
+        self.spath = path + ".executor.status.json"
+        self.mpath = os.path.join(metrics_dir, os.path.basename(path) + ".prom") if metrics_dir else None
+        self.start_s = time.time() - (datetime.now() - start_t).total_seconds()
+        self.estimate = estimate
+        self.n_workers = n_workers
+        self.mutex = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.finished = 0 # lines which reached a final status during this run
+        self.done = False
+
+    def set_state(self, state):
+        with self.mutex:
+            self.state = state
+            # line numbers are dense: per line arrays, indexed by idx
+            size = max([line.idx for line in state], default=0) + 1
+            self.statuses = array('b', [-1]) * size
+            self.estimates = array('d', [0.]) * size
+            self.counts = {st: 0 for st in St}
+            self.remaining_s = 0.
+            self.executing = {} # idx -> (worker, since)
+            for line in state:
+                self.statuses[line.idx] = line.status.value
+                self.counts[line.status] += 1
+                if line.status in [St.UNTREATED, St.EXECUTING]:
+                    self.add_estimate(line)
+                if line.status == St.EXECUTING and line.executedby:
+                    self.executing[line.idx] = (line.executedby[-1], time.time())
+
+    def add_estimate(self, line):
+        if self.estimate is not None:
+            self.estimates[line.idx] = self.estimate(line)
+            self.remaining_s += self.estimates[line.idx]
+
+    def update(self, lines):
+        with self.mutex:
+            for line in lines:
+                previous = St(self.statuses[line.idx])
+                self.statuses[line.idx] = line.status.value
+                self.counts[previous] -= 1
+                self.counts[line.status] += 1
+                was_pending = previous in [St.UNTREATED, St.EXECUTING]
+                if line.status in [St.UNTREATED, St.EXECUTING]:
+                    if not was_pending:
+                        self.add_estimate(line)
+                elif was_pending:
+                    self.remaining_s -= self.estimates[line.idx]
+                if line.status in FINAL_STATUSES and previous not in FINAL_STATUSES:
+                    self.finished += 1
+                if line.status == St.EXECUTING and line.executedby:
+                    self.executing[line.idx] = (line.executedby[-1], time.time())
+                else:
+                    self.executing.pop(line.idx, None)
+
+    def snapshot(self):
+        with self.mutex:
+            now = time.time()
+            elapsed_s = now - self.start_s
+            workers = {}
+            started_s = 0.
+            for idx, (worker, since) in self.executing.items():
+                started_s += min(now - since, self.estimates[idx])
+                if not isinstance(worker, str):
+                    worker = wid_to_str(worker)
+                workers[worker] = {"line": idx, "elapsed_s": now - since}
+            eta_s = None
+            if self.estimate is not None:
+                eta_s = max(0., self.remaining_s - started_s) / max(self.n_workers, len(workers), 1)
+            return {
+                "script": self.path,
+                "pid": os.getpid(),
+                "time": now,
+                "start_time": self.start_s,
+                "elapsed_s": elapsed_s,
+                "done": self.done,
+                "lines": len(self.state),
+                "counts": {st.name.lower(): self.counts[st] for st in St},
+                "lines_per_s": self.finished / elapsed_s if elapsed_s > 0 else 0.,
+                "eta_s": eta_s,
+                "workers": workers,
+                "lock": {"acquisitions": lock_stats.acquisitions, "wait_s": lock_stats.wait_s,
+                         "max_wait_s": lock_stats.max_wait_s, "hold_s": lock_stats.hold_s, "stale": lock_stats.stale},
+            }
+
+    def prometheus(self, status):
+        def labels(**pairs):
+            escaped = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                        .replace("\n", "\\n")) for name, value in sorted(pairs.items())]
+            return "{" + ",".join(escaped) + "}"
+        script = status["script"]
+        metrics = [
+            ("executor_lines", "gauge", "Lines of the script by status.",
+             [(labels(script=script, status=name), count) for name, count in status["counts"].items()]),
+            ("executor_lines_per_second", "gauge", "Lines finished per second since the start of the run.",
+             [(labels(script=script), status["lines_per_s"])]),
+            ("executor_eta_seconds", "gauge", "Estimated time left, from the durations of previous runs.",
+             [(labels(script=script), status["eta_s"])] if status["eta_s"] is not None else []),
+            ("executor_worker_line", "gauge", "Line each worker is executing.",
+             [(labels(script=script, worker=worker), current["line"])
+              for worker, current in sorted(status["workers"].items())]),
+            ("executor_lock_acquisitions_total", "counter", "State lock acquisitions by the executor process.",
+             [(labels(script=script), status["lock"]["acquisitions"])]),
+            ("executor_lock_wait_seconds_total", "counter", "Time the executor process waited for the state lock.",
+             [(labels(script=script), status["lock"]["wait_s"])]),
+            ("executor_start_time_seconds", "gauge", "Start of the run, seconds since the epoch.",
+             [(labels(script=script), status["start_time"])]),
+            ("executor_last_update_seconds", "gauge", "Time of this update, seconds since the epoch.",
+             [(labels(script=script), status["time"])]),
+        ]
+        rows = []
+        for name, kind, description, samples in metrics:
+            rows.append("# HELP {} {}".format(name, description))
+            rows.append("# TYPE {} {}".format(name, kind))
+            rows.extend(["{}{} {}".format(name, sample_labels, value) for sample_labels, value in samples])
+        return "\n".join(rows) + "\n"
+
+    def write(self):
+        # readers must never see a half written file. (other --parallel processes write them too)
+        status = self.snapshot()
+        outputs = [(self.spath, json.dumps(status, indent=1) + "\n")]
+        if self.mpath is not None:
+            outputs.append((self.mpath, self.prometheus(status)))
+        for path, text in outputs:
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, path)
+
+    def start(self):
+        if self.mpath is not None:
+            make_dir_if_not_exists(os.path.dirname(self.mpath))
+        def run():
+            while not self.stopped.wait(self.interval_s):
+                self.write()
+        self.write()
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.done = True
+        self.write()
 
 def all_succeeded(state):
     for line in state:
@@ -167,6 +603,9 @@ def is_comment(linetext):
         return False
     return linetext.strip(" ").startswith('#')
 
+def is_directive(linetext):
+    return is_comment(linetext) and linetext.strip(" #").split(" ")[0] == "executor"
+
 def find_line_with_tag(tag, state, before=None):
     for line in state:
         if before is not None and line.idx == before:
@@ -200,31 +639,85 @@ def after(state, idx):
             lines.append(line)
     return lines
 
+RESOURCE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+def parse_resources(args):
+    # ["cpu=4", "mem=8G"] -> {"cpu": 4., "mem": 8589934592.}. Units are powers of 1024
+    resources = {}
+    for arg in args:
+        match = re.match(r"^([a-zA-Z_][a-zA-Z0-9_]*)=([0-9]*\.?[0-9]+)([kKmMgGtT]?)[bB]?$", arg)
+        if match is None:
+            raise ValueError("invalid resource {} (expected NAME=AMOUNT, e.g. cpu=4 or mem=8G)".format(arg))
+        name, amount, unit = match.groups()
+        resources[name] = float(amount) * RESOURCE_UNITS[unit.upper()]
+    return resources
+
+def machine_capacity():
+    # what the lines can use at the same time by default: all the cpus and the physical memory
+    capacity = {"cpu": float(os.cpu_count() or 1)}
+    try:
+        capacity["mem"] = float(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    except (AttributeError, ValueError, OSError):
+        pass
+    return capacity
+
+def parse_values(args):
+    # ["1..3", "x"] -> ["1", "2", "3", "x"]. Ranges include both ends, and are zero padded if
+    # their first value is (01..10)
+    values = []
+    for arg in args:
+        match = re.match(r"^(-?[0-9]+)\.\.(-?[0-9]+)$", arg)
+        if match is None:
+            values.append(arg)
+            continue
+        first, last = match.groups()
+        width = len(first) if first.startswith("0") and len(first) > 1 else 0
+        step = 1 if int(last) >= int(first) else -1
+        values.extend([str(k).zfill(width) for k in range(int(first), int(last) + step, step)])
+    return values
+
+def substitute(text, variable, value):
+    # $variable and ${variable} in the text of a foreach line
+    return re.sub(r"\$(\{" + variable + r"\}|" + variable + r"(?![a-zA-Z0-9_]))", lambda match: value, text)
+
 def assign_dependencies(state):
-    for line in state:
+    # single pass: directives apply to the next line, except set-dependent / set-independent which
+    # apply to all the lines after the next one, and inputs / outputs / resources / foreach which
+    # apply to the next line which is not a directive (so that they can be combined with the others)
+    tags = {} # tag -> idx of the tagged line
+    chain_from = None # first set-dependent directive since the last set-independent
+    pending = {} # inputs / outputs / resources / foreach waiting for their line
+    for pos, line in enumerate(state):
+        if chain_from is not None and pos >= chain_from + 2:
+            # depends on its predecessor
+            line.dependencies.append(state[pos - 1].idx)
+        if pending and not is_directive(line.command):
+            line.inputs = pending.get("inputs")
+            line.outputs = pending.get("outputs")
+            line.resources = pending.get("resources")
+            line.foreach = pending.get("foreach")
+            pending = {}
         if not is_comment(line.command):
             continue
         line.dbginfo = "Comment"
         idx = line.idx
-        nextline = find_line_with_idx(idx + 1, state)
+        nextline = state[pos + 1] if pos + 1 < len(state) else None
         args = line.command.strip(" #").split(" ")
         if args and args.pop(0) == "executor":
             if args:
                 directive = args.pop(0)
             else:
                 raise ValueError("executor directive not specified: {}".format(line.command))
-                continue
             if nextline is None:
                 print("Warning: executor directive specified as last line. Ignoring.")
                 break
             if directive == "set-dependent":
                 # all following lines depend on their predecessor
-                for lnpredecessor, ln in zip(after(state, idx), after(state, idx+1)):
-                    ln.dependencies.append(lnpredecessor.idx)
+                if chain_from is None:
+                    chain_from = pos
             elif directive == "set-independent":
                 # all following lines lose their dependency
-                for ln in after(state, idx):
-                    ln.dependencies = []
+                chain_from = None
             elif directive == "always":
                 nextline.always = "always"
             elif directive == "always-try":
@@ -235,30 +728,100 @@ def assign_dependencies(state):
                     try:
                         condition = int(tag)
                     except ValueError:
-                        target = find_line_with_tag(tag, state, before=idx)
-                        if target is None:
+                        if tags.get(tag, idx) >= idx:
                             raise ValueError("if directive: tag not found: {}".format(line.command))
-                        condition = target.idx
+                        condition = tags[tag]
                 else:
                     raise ValueError("if condition not specified (# executor if NUMBER/TAG): {}".format(
                         line.command))
-                    continue
                 nextline.dependencies.append(condition)
             elif directive == "tag":
                 if args:
                     tag = args.pop(0)
-                    if find_line_with_tag(tag, state, before=idx) is not None:
+                    if tags.get(tag, idx) < idx:
                         raise ValueError("tag directive: tag already exists: {}".format(line.command))
                     nextline.tag = tag
+                    tags.setdefault(tag, nextline.idx)
                 else:
                     raise ValueError("tag not specified (# executor tag TAG): {}".format(line.command))
-                    continue
+            elif directive in ["inputs", "outputs"]:
+                paths = [arg for arg in args if arg]
+                if not paths:
+                    raise ValueError("{0} not specified (# executor {0} PATH [PATH ...]): {1}".format(
+                        directive, line.command))
+                pending.setdefault(directive, []).extend(paths)
+            elif directive == "resources":
+                resources = parse_resources([arg for arg in args if arg])
+                if not resources:
+                    raise ValueError("resources not specified (# executor resources NAME=AMOUNT ...): {}".format(
+                        line.command))
+                pending.setdefault(directive, {}).update(resources)
+            elif directive == "foreach":
+                args = [arg for arg in args if arg]
+                if (len(args) < 3 or args[1] != "in" or "foreach" in pending
+                        or re.match(r"^[a-zA-Z_][a-zA-Z0-9_]*$", args[0]) is None):
+                    raise ValueError("foreach: expected # executor foreach VARIABLE in VALUES (e.g. 1..8, or a b c), "
+                                     "once per line: {}".format(line.command))
+                pending[directive] = (args[0], parse_values(args[2:]))
 
             else:
                 raise ValueError("unknown directive: {} in {}".format(directive, line.command))
         else:
             continue
 
+def in_script_order(lines):
+    # lines sorted by idx: the items of each foreach line go back right before it
+    items = {}
+    for line in lines:
+        if line.source is not None:
+            items.setdefault(line.source, []).append(line)
+    if not items:
+        return lines
+    ordered = []
+    for line in lines:
+        if line.source is None:
+            ordered.extend(items.get(line.idx, []))
+            ordered.append(line)
+    return ordered
+
+def expand_foreach(state):
+    # each line with a foreach directive is preceded by one line per value of the variable (its
+    # items, numbered after the last line of the script), and only waits for them: depending on the
+    # line means depending on all of its items. Items share the text and dependencies of the line
+    if not any([line.foreach for line in state]):
+        return state
+    expanded = []
+    next_idx = max([line.idx for line in state]) + 1
+    for line in state:
+        if line.foreach is None:
+            expanded.append(line)
+            continue
+        if is_noop(line.command) or line.always != "no":
+            raise ValueError("line {}: foreach needs a command, which is not always executed: {}".format(
+                line.idx, line.origtext))
+        variable, values = line.foreach
+        line.items = []
+        for value in values:
+            item = Line(next_idx, substitute(line.command, variable, value), line.origtext)
+            item.source = line.idx
+            item.item = value
+            item.dependencies = line.dependencies
+            item.resources = line.resources
+            if line.inputs is not None:
+                item.inputs = [substitute(path, variable, value) for path in line.inputs]
+            if line.outputs is not None:
+                item.outputs = [substitute(path, variable, value) for path in line.outputs]
+            item.dbginfo = "{}={}".format(variable, value)
+            expanded.append(item)
+            line.items.append(next_idx)
+            next_idx += 1
+        line.command = None
+        line.dependencies = list(line.items)
+        line.inputs = line.outputs = line.resources = None
+        line.dbginfo = "foreach {} in {} values".format(variable, len(values))
+        expanded.append(line)
+    return expanded
+
 def detect_incompatible_commands(state):
     for line in state:
         if line.command is None:
@@ -271,20 +834,282 @@ def detect_incompatible_commands(state):
                 line.idx, line.command))
 
 
-def execute_line(line, ishell):
-    if line.command is None:
-        return 0, ""
-    if is_comment(line.command):
+FINAL_STATUSES = [St.SKIPPED, St.SUCCEEDED, St.FAILED]
+
+class Usage(object):
+    # resources taken by the executing lines, see Scheduler. The schedulers of a batch of scripts
+    # share one, so that the lines of all the scripts count against the same capacity
+    def __init__(self):
+        self.in_use = {} # resource -> amount
+        self.holders = 0 # number of executing lines counted in in_use
+
+class Scheduler(object):
+    # dependency graph of a state, built once: lines by idx, reverse dependency edges, number of
+    # unmet dependencies per line, and a queue of the lines which are ready to be executed.
+    # Ready lines are executed in script order, or if estimate (line -> expected seconds) is given,
+    # longest remaining path first. Lines never move across an "always" line: it changes the state
+    # of the shell the lines after it expect.
+    # If capacity (resource -> amount) is given, a line only starts if its resources fit next to
+    # those of the lines executing, in this process or in others. Otherwise a smaller ready line
+    # may go first (backfill), looking at most backfill_window lines down the queue.
+    backfill_window = 1000
+
+    def __init__(self, state, estimate=None, capacity=None, usage=None):
+        self.lines = {}
+        self.known = {}
+        self.dependents = {}
+        self.remaining = {}
+        self.ready = []
+        self.capacity = capacity
+        self.usage = Usage() if usage is None else usage
+        self.holding = set() # idx of the executing lines counted in usage
+        self.start_t = time.time()
+        self.ready_at = {} # when each line became ready, for the trace
+        for line in state:
+            self.lines[line.idx] = line
+            self.known[line.idx] = line.status
+            self.dependents[line.idx] = []
+        for line in state:
+            deps = set(line.dependencies)
+            for dep in deps:
+                if dep not in self.lines:
+                    raise ValueError("line {} depends on line {} which does not exist".format(
+                        line.idx, dep))
+                self.dependents[dep].append(line.idx)
+            self.remaining[line.idx] = len([dep for dep in deps if self.lines[dep].status != St.SUCCEEDED])
+        priorities = {} if estimate is None else self.critical_paths(state, estimate)
+        self.keys = {}
+        segment = 0
+        for pos, line in enumerate(state):
+            # script order is the order of the state: foreach items come before their line
+            if line.always != "no":
+                segment += 1
+                self.keys[line.idx] = (segment, -float("inf"), pos, line.idx)
+            else:
+                self.keys[line.idx] = (segment, -priorities.get(line.idx, 0.), pos, line.idx)
+        for line in state:
+            if line.always != "no": # "always" ignores dependencies, and runs again when resuming
+                self.push(line)
+            elif line.status == St.UNTREATED and self.remaining[line.idx] == 0:
+                self.push(line)
+        for line in state:
+            if line.status in [St.SKIPPED, St.FAILED]:
+                self.propagate_skip(line)
+            elif line.status == St.EXECUTING:
+                self.acquire(line)
+
+    def critical_paths(self, state, estimate):
+        # idx -> estimated time from the start of the line to the end of its longest chain of
+        # dependents. Dependencies come in topological order, usually before their dependents
+        unmet = {line.idx: len(set(line.dependencies)) for line in state}
+        order = [line.idx for line in state if unmet[line.idx] == 0]
+        for idx in order:
+            for dependent in self.dependents[idx]:
+                unmet[dependent] -= 1
+                if unmet[dependent] == 0:
+                    order.append(dependent)
+        paths = {}
+        for idx in reversed(order):
+            line = self.lines[idx]
+            own = estimate(line) if line.status in [St.UNTREATED, St.EXECUTING] else 0.
+            paths[idx] = own + max([paths[dependent] for dependent in self.dependents[idx]], default=0.)
+        return paths
+
+    def push(self, line):
+        heapq.heappush(self.ready, self.keys[line.idx])
+        self.ready_at[line.idx] = time.time()
+
+    def pop(self):
+        # next line to execute, None if no line is ready (yet), or none fits in the capacity left.
+        # The caller is expected to execute it: its resources are taken until it is finished
+        deferred = []
+        found = None
+        while self.ready and len(deferred) < self.backfill_window:
+            key = heapq.heappop(self.ready)
+            line = self.lines[key[-1]]
+            if line.always == "no" and line.status != St.UNTREATED:
+                continue
+            if deferred and key[0] != deferred[0][0]:
+                # no backfill across an "always" line
+                deferred.append(key)
+                break
+            if not self.fits(line):
+                deferred.append(key)
+                continue
+            found = line
+            break
+        for key in deferred:
+            heapq.heappush(self.ready, key)
+        if found is not None:
+            self.acquire(found)
+        return found
+
+    def fits(self, line):
+        # a line which needs more than the capacity runs alone
+        if self.capacity is None or not line.resources or not self.usage.holders:
+            return True
+        return all([self.usage.in_use.get(name, 0.) + amount <= self.capacity.get(name, float("inf"))
+                    for name, amount in line.resources.items()])
+
+    def acquire(self, line):
+        if line.resources and line.idx not in self.holding:
+            self.holding.add(line.idx)
+            self.usage.holders += 1
+            for name, amount in line.resources.items():
+                self.usage.in_use[name] = self.usage.in_use.get(name, 0.) + amount
+
+    def release(self, line):
+        if line.idx in self.holding:
+            self.holding.remove(line.idx)
+            self.usage.holders -= 1
+            for name, amount in line.resources.items():
+                self.usage.in_use[name] -= amount
+
+    def finish(self, line):
+        # call once a line has reached its final status, returns the lines which got skipped as
+        # a consequence. Also called with the lines other workers started
+        if line.status == St.EXECUTING:
+            self.acquire(line)
+        else:
+            self.release(line)
+        if self.known[line.idx] in FINAL_STATUSES:
+            # e.g. "always" lines, which run again although they already succeeded
+            return []
+        self.known[line.idx] = line.status
+        if line.status == St.UNTREATED and self.remaining[line.idx] == 0 and line.always == "no":
+            # given back, e.g. reclaimed from a worker which is gone
+            self.push(line)
+        if line.status not in FINAL_STATUSES:
+            return []
+        if line.status == St.SUCCEEDED:
+            for idx in self.dependents[line.idx]:
+                self.remaining[idx] -= 1
+                dependent = self.lines[idx]
+                if self.remaining[idx] == 0 and dependent.status == St.UNTREATED and dependent.always == "no":
+                    self.push(dependent)
+            return []
+        return self.propagate_skip(line)
+
+    def propagate_skip(self, line):
+        skipped = []
+        stack = [line]
+        while stack:
+            for idx in self.dependents[stack.pop().idx]:
+                dependent = self.lines[idx]
+                if dependent.status == St.UNTREATED and dependent.always == "no":
+                    dependent.status = St.SKIPPED
+                    self.known[idx] = St.SKIPPED
+                    skipped.append(dependent)
+                    stack.append(dependent)
+        return skipped
+
+    def refresh(self, state):
+        # the state was reloaded from disk: switch to the new lines, and catch up with the status
+        # changes made by other workers
+        skipped = []
+        self.lines = {line.idx: line for line in state}
+        for line in state:
+            if line.status != self.known[line.idx]:
+                skipped.extend(self.finish(line))
+        return skipped
+
+OUTPUT_TAIL_SIZE = 4096
+log_lock = threading.Lock()
+
+class OutputSink(object):
+    # set as the shell's logfile_read: streams the output of the line being executed to its own
+    # file, and only keeps the tail in memory.
+    # The last bytes are held back, as they may turn out to be the prompt.
+    holdback = 256
+
+    def __init__(self, path, workeruid):
+        self.outdir = path + ".executor.out"
+        self.lpath = path + ".executor.{}.log".format(workeruid[0])
+        make_dir_if_not_exists(self.outdir)
+        self.line = None
+        self.file = None
+
+    def start(self, line):
+        self.line = line
+        self.file = open(os.path.join(self.outdir, "{}.log".format(line.idx)), 'wb')
+        self.pending = b""
+        self.tail = b""
+        self.nbytes = 0
+
+    def write(self, data):
+        if self.file is None: # not executing a line
+            return
+        self.pending += data
+        if len(self.pending) > self.holdback:
+            self.emit(self.pending[:-self.holdback])
+            self.pending = self.pending[-self.holdback:]
+
+    def flush(self):
+        pass
+
+    def emit(self, data):
+        self.file.write(data)
+        self.nbytes += len(data)
+        self.tail = (self.tail + data)[-OUTPUT_TAIL_SIZE:]
+
+    def finish(self, excess):
+        # excess: number of bytes received after the end of the output (prompt and after)
+        self.emit(self.pending[:max(0, len(self.pending) - excess)])
+        self.file.close()
+        self.file = None
+        self.line.output_path = os.path.join(self.outdir, "{}.log".format(self.line.idx))
+        self.line.output_bytes = self.nbytes
+        self.line.log_offset = append_to_log(self.lpath, self.line.output_path)
+        return self.tail.decode(errors='replace')
+
+def append_to_log(lpath, opath):
+    # appends a line's output to the combined log, returns the offset it was written at
+    with log_lock:
+        with open(lpath, 'ab') as log, open(opath, 'rb') as output:
+            offset = log.tell()
+            shutil.copyfileobj(output, log)
+            log.write(b"\n")
+    return offset
+
+def is_noop(command):
+    # continuation, empty and comment lines need no shell
+    return command is None or command.strip() == "" or is_comment(command)
+
+READ_CHUNK = 65536
+PROMPT_WINDOW = 256 # longer than the prompt
+
+def wait_for_prompt(ishell, sink=None):
+    # reads the output of the command until the prompt, in large chunks. The prompt is only
+    # searched for in the new bytes and the end of the previous ones: pexpect's expect searches
+    # its whole buffer after each read, and keeps it, which is quadratic in the size of the output.
+    # The output goes to the sink (the shell's logfile_read) as it is read, without a sink it is
+    # returned. Returns the return code, the output and the number of bytes received after it
+    chunks = []
+    window = b""
+    while True:
+        data = ishell.read_nonblocking(READ_CHUNK, timeout=None)
+        if sink is None:
+            chunks.append(data)
+        window = window[-PROMPT_WINDOW:] + data
+        match = ishell.prompt.search(window)
+        if match is not None:
+            break
+    excess = len(window) - match.start()
+    output = b"".join(chunks)[:-excess] if sink is None else b""
+    return int(match.group(1)), output, excess
+
+def execute_line(line, ishell, sink=None):
+    if is_noop(line.command):
         return 0, ""
+    if sink is not None:
+        sink.start(line)
     ishell.sendline(line.command)
-    ishell.expect(r'\$ ', timeout=None)
-    out = ishell.before.decode()
-    # get retcode
-    ishell.sendline("echo $?")
-    ishell.expect(r'\$ ')
-    ret = ishell.before.decode()
-    ret = ret.split('\r\n')[1]
-    ret = int(ret)
+    # the prompt contains the return code
+    ret, out, excess = wait_for_prompt(ishell, sink)
+    if sink is not None:
+        out = sink.finish(excess)
+    else:
+        out = out.decode(errors='replace')
 #     if DEBUG:
 #         pass
 #         print(out)
@@ -293,10 +1118,189 @@ def execute_line(line, ishell):
 #             return 1, ""
     return ret, out
 
-def execute_line_unless(line, ishell, interactive, skip):
+def expand_paths(patterns):
+    # files matching the patterns, directories are walked. None if a pattern matches nothing
+    import glob
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.abspath(pattern)))
+        if not matches:
+            return None
+        for match in matches:
+            if os.path.isdir(match):
+                for dirpath, dirnames, filenames in os.walk(match):
+                    dirnames.sort()
+                    paths.extend([os.path.join(dirpath, name) for name in sorted(filenames)])
+            else:
+                paths.append(match)
+    return paths
+
+class Fingerprints(object):
+    # make-style up to date check, for lines with inputs / outputs directives: a line is up to date
+    # if it already succeeded with the same command, inputs (by content) and outputs, and all its
+    # outputs exist. Records are appended to <script>.executor.fingerprints, keyed by command
+    # text and declared inputs / outputs (see key) so that they survive edits of the script.
+    # Input hashes are also recorded, with the size and mtime of the file, so that only modified
+    # files get hashed again.
+    def __init__(self):
+        self.fpath = None
+        self.check_enabled = False
+        self.lines = {} # key -> fingerprint of its last success
+        self.hashes = {} # path -> (size, mtime_ns, sha1)
+        self.mutex = threading.Lock()
+
+    def enable(self, path, check=True):
+        self.fpath = path + ".executor.fingerprints"
+        self.check_enabled = check
+        n_records = 0
+        if os.path.exists(self.fpath):
+            with open(self.fpath, 'r') as f:
+                for text in f:
+                    try:
+                        record = json.loads(text)
+                    except ValueError: # interrupted write
+                        continue
+                    n_records += 1
+                    if "line" in record:
+                        self.lines[record["line"]] = record["fingerprint"]
+                    elif "command" in record:
+                        # keyed by command only (executor <= 0.0.5): the line executes once more
+                        continue
+                    else:
+                        self.hashes[record["file"]] = (record["size"], record["mtime_ns"], record["sha1"])
+        if n_records > 2 * (len(self.lines) + len(self.hashes)) + 1000:
+            self.compact()
+
+    def append(self, records):
+        if records:
+            with open(self.fpath, 'a') as f:
+                f.write("".join([json.dumps(record) + "\n" for record in records]))
+
+    def compact(self):
+        records = [{"line": key, "fingerprint": fingerprint} for key, fingerprint in self.lines.items()]
+        records.extend([{"file": path, "size": size, "mtime_ns": mtime_ns, "sha1": sha1}
+                        for path, (size, mtime_ns, sha1) in self.hashes.items()])
+        with open(self.fpath + ".tmp", 'w') as f:
+            f.write("".join([json.dumps(record) + "\n" for record in records]))
+        os.replace(self.fpath + ".tmp", self.fpath)
+
+    def key(self, line):
+        # the same command can appear with different inputs / outputs, e.g. the items of a foreach
+        # line which only use the variable in their paths
+        return json.dumps([line.command, sorted(line.inputs or []), sorted(line.outputs or [])])
+
+    def file_hash(self, path, new_records):
+        stat = os.stat(path)
+        known = self.hashes.get(path)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        self.hashes[path] = (stat.st_size, stat.st_mtime_ns, sha1.hexdigest())
+        new_records.append({"file": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                            "sha1": sha1.hexdigest()})
+        return sha1.hexdigest()
+
+    def check(self, line):
+        # returns the fingerprint of the line (None if an input is missing), and whether it is up
+        # to date
+        if self.fpath is None:
+            return None, False
+        with self.mutex:
+            inputs = expand_paths(line.inputs or [])
+            if inputs is None:
+                return None, False
+            new_records = []
+            parts = [line.command, "outputs"] + [os.path.abspath(output) for output in line.outputs or []]
+            parts.append("inputs")
+            for path in inputs:
+                parts.extend([path, self.file_hash(path, new_records)])
+            self.append(new_records)
+            fingerprint = hashlib.sha1("\0".join(parts).encode()).hexdigest()
+            uptodate = (self.check_enabled and self.lines.get(self.key(line)) == fingerprint
+                        and expand_paths(line.outputs or []) is not None)
+            return fingerprint, uptodate
+
+    def record(self, line, fingerprint):
+        key = self.key(line)
+        with self.mutex:
+            self.lines[key] = fingerprint
+            self.append([{"line": key, "fingerprint": fingerprint}])
+
+fingerprints = Fingerprints()
+
+class Durations(object):
+    # how long commands took, averaged over runs, to execute the longest chains first. Appended to
+    # <script>.executor.durations, keyed by command text (like Fingerprints)
+    def __init__(self):
+        self.dpath = None
+        self.estimates = {} # command -> seconds
+        self.total = 0.
+        self.mutex = threading.Lock()
+
+    def enable(self, path):
+        self.dpath = path + ".executor.durations"
+        n_records = 0
+        if os.path.exists(self.dpath):
+            with open(self.dpath, 'r') as f:
+                for text in f:
+                    try:
+                        record = json.loads(text)
+                    except ValueError: # interrupted write
+                        continue
+                    n_records += 1
+                    self.update(record["command"], record["duration"])
+        if n_records > 2 * len(self.estimates) + 1000:
+            with open(self.dpath + ".tmp", 'w') as f:
+                f.write("".join([json.dumps({"command": command, "duration": duration}) + "\n"
+                                 for command, duration in self.estimates.items()]))
+            os.replace(self.dpath + ".tmp", self.dpath)
+
+    def update(self, command, duration):
+        previous = self.estimates.get(command)
+        self.estimates[command] = duration if previous is None else (previous + duration) / 2.
+        self.total += self.estimates[command] - (previous or 0.)
+
+    def record(self, line):
+        if self.dpath is None or is_noop(line.command) or line.starttime is None or line.endtime is None:
+            return
+        duration = (line.endtime - line.starttime).total_seconds()
+        with self.mutex:
+            self.update(line.command, duration)
+            with open(self.dpath, 'a') as f:
+                f.write(json.dumps({"command": line.command, "duration": duration}) + "\n")
+
+    def estimate(self, line):
+        if is_noop(line.command):
+            return 0.
+        if line.command in self.estimates:
+            return self.estimates[line.command]
+        return self.default()
+
+    def default(self):
+        # for commands never executed: as long as an average line, so that longer chains still go first
+        if self.estimates:
+            return self.total / len(self.estimates)
+        return 1.
+
+durations = Durations()
+
+def execute_line_unless(line, ishell, interactive, skip, sink=None, fingerprints=fingerprints, durations=durations):
+    # fingerprints, durations: those of the line's script, when running several scripts
     execute_this_line = True
     if skip:
         execute_this_line = False
+    fingerprint = None
+    if execute_this_line and (line.inputs is not None or line.outputs is not None):
+        fingerprint, uptodate = fingerprints.check(line)
+        if uptodate:
+            line.status = St.SUCCEEDED
+            line.retcode = 0
+            line.output = ""
+            line.uptodate = True
+            return
     if execute_this_line and interactive:
         print("")
         print("Going to execute line {}. Execute or skip? [e/s]".format(line.idx))
@@ -307,23 +1311,777 @@ def execute_line_unless(line, ishell, interactive, skip):
             execute_this_line = False
     if execute_this_line:
         line.starttime = datetime.now()
-        retcode, output = execute_line(line, ishell)
+        line.uptodate = False
+        retcode, output = execute_line(line, ishell, sink)
         line.retcode = retcode
         line.output = output
         line.endtime = datetime.now()
+        durations.record(line)
         if retcode == 0:
             line.status = St.SUCCEEDED
+            if fingerprint is not None:
+                fingerprints.record(line, fingerprint)
         else:
             line.status = St.FAILED
     else:
         line.status = St.SKIPPED
 
+def spawn_shell(args="", sink=None):
+    import pexpect
+    import uuid
+    ishell = pexpect.spawn("/bin/bash")
+    # the output of each line is in its own file (see OutputSink), no need for a copy of everything
+    ishell.logfile_read = sink
+    # bash reads the command lines it is sent without help, pexpect's default waits 50ms before each
+    ishell.delaybeforesend = None
+    # replace the user's prompt with one which can not be mistaken for output, and carries the
+    # return code of the last command. (the echoed command line shows $? instead of a number)
+    sentinel = "_EXECUTOR_{}_".format(uuid.uuid4().hex[:12])
+    ishell.prompt = re.compile("{0}([0-9]+){0}".format(sentinel).encode())
+    ishell.sendline("unset PROMPT_COMMAND; bind 'set enable-bracketed-paste off' 2>/dev/null; "
+                    "PS1='{0}$?{0}'".format(sentinel))
+    wait_for_prompt(ishell)
+    if args != "":
+        ishell.sendline("set {}".format(args))
+        wait_for_prompt(ishell)
+    return ishell
+
+def pending_always_lines(always_lines, applied, line):
+    # "always" lines which a shell must run before line, to be in the same state as a sequential
+    # execution would be
+    idx = line.idx if line.source is None else line.source
+    return [prev for prev in always_lines if prev.idx < idx and prev.idx not in applied]
+
+class ShellPool(object):
+    # shells started ahead of time, in the background, so that workers don't wait for bash to
+    # start: take() hands out a ready shell (started with args) and starts another one, to keep
+    # spare shells ready. Shells are closed in the background as well (each takes 0.1s).
+    def __init__(self, args="", spare=0):
+        self.args = args
+        self.spare = spare
+        self.ready = queue.Queue()
+        self.mutex = threading.Lock()
+        self.starting = 0
+        self.waiting = 0
+        self.threads = []
+        self.closed = False
+        self.fill()
+
+    def background(self, function):
+        thread = threading.Thread(target=function)
+        thread.daemon = True
+        with self.mutex:
+            self.threads = [other for other in self.threads if other.is_alive()] + [thread]
+        thread.start()
+
+    def fill(self, extra=0):
+        with self.mutex:
+            missing = self.spare + self.waiting + extra - self.ready.qsize() - self.starting
+            missing = 0 if self.closed else max(0, missing)
+            self.starting += missing
+        for _ in range(missing):
+            self.background(self.start_one)
+
+    def warm(self, n):
+        # starts n more shells, e.g. as many as there are workers, before they are needed
+        self.fill(extra=n)
+
+    def start_one(self):
+        try:
+            ishell = spawn_shell(self.args)
+        except Exception as e: # raised in the worker which takes it
+            ishell = e
+        with self.mutex:
+            self.starting -= 1
+            if not self.closed:
+                self.ready.put(ishell)
+                return
+        if not isinstance(ishell, Exception):
+            ishell.close()
+
+    def take(self, sink=None):
+        with self.mutex:
+            self.waiting += 1
+        self.fill()
+        ishell = self.ready.get()
+        with self.mutex:
+            self.waiting -= 1
+        self.fill()
+        if isinstance(ishell, Exception):
+            raise ishell
+        ishell.logfile_read = sink
+        return ishell
+
+    def retire(self, ishell):
+        self.background(ishell.close)
+
+    def close(self, shells=()):
+        # closes the spare shells and the given ones, and waits for all of them
+        with self.mutex:
+            self.closed = True
+        spares = []
+        while not self.ready.empty():
+            spares.append(self.ready.get())
+        for ishell in list(shells) + spares:
+            if ishell is not None and not isinstance(ishell, Exception):
+                self.retire(ishell)
+        with self.mutex:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+
+# variables which belong to each shell, or which bash sets itself
+ENV_SPECIAL = ("BASH*|COMP_*|DIRSTACK|EPOCHREALTIME|EPOCHSECONDS|EUID|FUNCNAME|GROUPS|HISTCMD|LINENO|OLDPWD|"
+               "PIPESTATUS|PPID|PS1|PS2|PROMPT_COMMAND|PWD|RANDOM|SECONDS|SHELLOPTS|SHLVL|SRANDOM|UID|_|_executor_*")
+# writes the working directory, the positional parameters, the names of the variables, then
+# statements which restore the variables, functions, aliases, options and umask
+ENV_CAPTURE = "; ".join([
+    "_executor_names=",
+    "for _executor_name in $(compgen -v); do case $_executor_name in {special}) ;; "
+    "*) _executor_names+=\" $_executor_name\" ;; esac; done",
+    "{{ printf '%q\\n' \"$PWD\"",
+    "if [ $# -gt 0 ]; then printf '%q ' \"$@\"; fi",
+    "printf '\\n%s\\n' \"$_executor_names\"",
+    "declare -p $_executor_names",
+    "declare -f",
+    "alias -p",
+    "shopt -p",
+    "set +o",
+    "umask -p; }} > {path}",
+    "unset _executor_name _executor_names"])
+
+class Environments(object):
+    # snapshots of the state a shell is in after each "always" line: working directory, positional
+    # parameters, variables (exported or not), functions, aliases, options and umask. The first
+    # shell which runs an always line takes one, the other shells of the process source it instead
+    # of running the always lines before their next line. Snapshots are shell scripts, in a
+    # temporary directory.
+    def __init__(self):
+        self.directory = None
+        self.paths = {} # idx of the always line -> snapshot
+        self.events = {} # idx of the always lines being run -> set once their snapshot is taken
+        self.mutex = threading.Lock()
+
+    def begin(self, idx):
+        # a shell is going to run the always line idx: the others wait for its snapshot
+        with self.mutex:
+            if idx not in self.paths:
+                self.events[idx] = threading.Event()
+
+    def release(self, idx):
+        # the snapshot of idx is taken, or will not be
+        with self.mutex:
+            event = self.events.pop(idx, None)
+        if event is not None:
+            event.set()
+
+    def get(self, idx, wait=False):
+        with self.mutex:
+            spath = self.paths.get(idx)
+            event = self.events.get(idx)
+        if spath is None and wait and event is not None:
+            event.wait()
+            with self.mutex:
+                spath = self.paths.get(idx)
+        return spath
+
+    def capture(self, idx, ishell):
+        try:
+            spath = self.snapshot(idx, ishell)
+            if spath is not None:
+                with self.mutex:
+                    self.paths.setdefault(idx, spath)
+        finally:
+            self.release(idx)
+
+    def snapshot(self, idx, ishell):
+        import tempfile
+        with self.mutex:
+            if idx in self.paths:
+                return None
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="executor_env_")
+        raw = os.path.join(self.directory, "{}.{}.raw".format(idx, id(ishell)))
+        ishell.sendline(ENV_CAPTURE.format(special=ENV_SPECIAL, path=raw))
+        wait_for_prompt(ishell)
+        try:
+            with open(raw, 'r') as f:
+                cwd, positional, names, statements = f.read().split("\n", 3)
+            os.remove(raw)
+        except (OSError, ValueError): # e.g. a shell without compgen
+            return None
+        # variables the always lines unset are unset as well
+        snapshot = ("cd -- {cwd} || return 1\n"
+                    "set -- {positional}\n"
+                    "for _executor_name in $(compgen -v); do\n"
+                    "  case $_executor_name in {special}) ;; *)\n"
+                    "    case '{names} ' in *\" $_executor_name \"*) ;; *) unset \"$_executor_name\" ;; esac ;;\n"
+                    "  esac\n"
+                    "done 2>/dev/null\n"
+                    "unset _executor_name\n"
+                    "{statements}").format(cwd=cwd, positional=positional, special=ENV_SPECIAL, names=names,
+                                           statements=statements)
+        spath = os.path.join(self.directory, "{}.{}.sh".format(idx, id(ishell)))
+        with open(spath, 'w') as f:
+            f.write(snapshot)
+        return spath
+
+    def apply(self, ishell, spath):
+        import shlex
+        ishell.sendline("source {}".format(shlex.quote(spath)))
+        retcode, _, _ = wait_for_prompt(ishell)
+        return retcode == 0
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+def catch_up(ishell, always_lines, applied, line, environments, worker=None):
+    # gets the shell in the state the always lines before line leave it in: sources the snapshot
+    # taken after the last of them which has one, then runs the ones after it. Returns the
+    # always-required line which failed, if any
+    pending = pending_always_lines(always_lines, applied, line)
+    start = 0
+    for k in range(len(pending) - 1, -1, -1):
+        # the snapshot of the last one may be on its way, from the shell which runs it
+        spath = environments.get(pending[k].idx, wait=k == len(pending) - 1)
+        if spath is None:
+            continue
+        with tracer.span("env", worker, pending[k].idx):
+            restored = environments.apply(ishell, spath)
+        if restored:
+            applied.update([prev.idx for prev in pending[:k + 1]])
+            start = k + 1
+        break
+    for prev in pending[start:]:
+        with tracer.span("always", worker, prev.idx):
+            retcode, _ = execute_line(prev, ishell)
+        applied.add(prev.idx)
+        if retcode != 0 and prev.always == "always":
+            return prev
+        environments.capture(prev.idx, ishell)
+    return None
+
+def run_jobs(path, state, journal, workeruids, shells, sinks, renderer, capacity=None):
+    # in-process worker pool: this thread owns the state and hands out lines as soon as they are
+    # ready, each worker thread drives its own shell
+    always_lines = [line for line in state if line.always != "no"]
+    environments = Environments()
+    inboxes = [queue.Queue() for _ in shells]
+    results = queue.Queue()
+
+    def work(k):
+        applied = set()
+        while True:
+            line = inboxes[k].get()
+            if line is None:
+                return
+            try:
+                failed = catch_up(shells[k], always_lines, applied, line, environments, workeruids[k])
+                if failed is not None:
+                    results.put((k, line, "Always-required line {} failed in worker {}.".format(failed.idx, k)))
+                else:
+                    with tracer.span("exec", workeruids[k], line.idx):
+                        execute_line_unless(line, shells[k], False, False, sinks[k])
+                    applied.add(line.idx)
+                    if line.always != "no" and (line.status == St.SUCCEEDED or line.always == "always-try"):
+                        environments.capture(line.idx, shells[k])
+                    results.put((k, line, None))
+                environments.release(line.idx)
+            except Exception as e:
+                environments.release(line.idx)
+                results.put((k, line, "Worker {} crashed: {}".format(k, e)))
+                return
+
+    threads = [threading.Thread(target=work, args=(k,)) for k in range(len(shells))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    scheduler = Scheduler(state, durations.estimate, capacity)
+    coordinator = wid_to_str(workeruids[0][:-1]) + "___coordinator"
+    idle = list(range(len(shells)))[::-1]
+    running = {}
+    aborting = False
+    try:
+        while True:
+            while idle and not aborting:
+                line = scheduler.pop()
+                if line is None:
+                    break
+                if is_noop(line.command):
+                    # nothing to run, no need to go through a shell
+                    execute_line_unless(line, None, False, False)
+                    with tracer.span("state", coordinator, line.idx):
+                        changed = [line] + scheduler.finish(line)
+                        journal.append(changed, workeruids[0])
+                    renderer.update(changed)
+                    continue
+                k = idle.pop()
+                tracer.waits(line, scheduler, workeruids[k])
+                line.start(workeruids[k])
+                with tracer.span("state", coordinator, line.idx):
+                    journal.append([line], workeruids[0])
+                renderer.update([line])
+                running[line.idx] = k
+                if line.always != "no":
+                    environments.begin(line.idx)
+                inboxes[k].put(line)
+            if not running:
+                break
+            k, line, error = results.get()
+            del running[line.idx]
+            idle.append(k)
+            if error is not None:
+                renderer.message(error + " Aborting.")
+                line.requeue()
+                journal.append([line], workeruids[0])
+                renderer.update([line])
+                aborting = True
+                continue
+            if line.status != St.SUCCEEDED and line.always == "always":
+                renderer.message("Always-required command failed. Aborting.")
+                aborting = True
+            with tracer.span("state", coordinator, line.idx):
+                changed = [line] + scheduler.finish(line)
+                journal.append(changed, workeruids[0])
+            renderer.update(changed)
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        environments.close()
+    return state
+
+def script_paths(path):
+    # the scripts designated by path: a script, a directory (its .sh files), a glob pattern, or
+    # several of those separated by commas (or in a list)
+    import glob
+    if isinstance(path, (list, tuple)):
+        patterns = [str(pattern) for pattern in path]
+    elif os.path.exists(path) or "," not in path:
+        patterns = [path]
+    else:
+        patterns = [pattern for pattern in path.split(",") if pattern]
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, "*.sh")))
+        elif any([char in pattern for char in "*?["]):
+            matches = sorted([match for match in glob.glob(pattern) if os.path.isfile(match)])
+        else:
+            matches = [pattern]
+        matches = [os.path.abspath(match) for match in matches]
+        # not the files executor keeps next to the scripts
+        scripts = set(matches)
+        for match in matches:
+            if match.split(".executor")[0] in scripts and match.split(".executor")[0] != match:
+                continue
+            if match not in paths:
+                paths.append(match)
+    return paths
+
+class BatchScript(object):
+    # one script of a batch: what main keeps for a script, except the shells, which are shared
+    def __init__(self, path, workeruid, backend):
+        self.path = path
+        self.label = os.path.relpath(path)
+        self.workeruid = workeruid
+        self.journal = SqliteStore(path) if backend == "sqlite" else Journal(path)
+        self.leases = Leases()
+        self.fingerprints = Fingerprints()
+        self.durations = Durations()
+        self.environments = Environments()
+        self.sinks = {} # shell -> OutputSink
+        self.state = None
+        self.scheduler = None
+        self.renderer = None
+        self.always_lines = []
+        self.running = 0
+        self.served = 0 # when a line of the script was last handed out
+        self.aborting = False
+        self.done = False
+
+    def sink(self, k):
+        if k not in self.sinks:
+            self.sinks[k] = OutputSink(self.path, self.workeruid)
+        return self.sinks[k]
+
+def run_batch(paths, args, workeruid, jobs, force_rerun=False, cont=False, plain=False, quiet=False, lease=30.,
+              retries=1, backend="journal", capacity=None, metrics=""):
+    # several scripts on one pool of jobs shells (executor scripts/ --jobs N). Each script keeps
+    # its own lock, state, resume choice, history and "always" lines. The next line goes to the
+    # script with the fewest lines executing, then to one an idle shell was started for, then to
+    # the one served least recently. A shell is replaced by a new one (from a pool of shells
+    # started in advance) when it goes to another script, so that scripts never see each other's
+    # cd, variables or "always" lines. Resources are counted across all the scripts.
+    start_t = datetime.now()
+    workeruids = [workeruid + (k,) for k in range(jobs)]
+    scripts = []
+    usage = Usage() # shared by the schedulers of the scripts
+    # a few shells ready for the workers which move to another script
+    pool = ShellPool(args, spare=min(jobs, 4))
+    shells = [None] * jobs
+    bound = [None] * jobs # script each shell was started for
+    inboxes = [queue.Queue() for _ in range(jobs)]
+    results = queue.Queue()
+
+    def work(k):
+        current = None
+        applied = set()
+        while True:
+            task = inboxes[k].get()
+            if task is None:
+                return
+            script, line = task
+            try:
+                if current is not script:
+                    current = None
+                    if shells[k] is not None:
+                        pool.retire(shells[k])
+                        shells[k] = None
+                    shells[k] = pool.take(script.sink(k))
+                    current = script
+                    applied = set()
+                failed = catch_up(shells[k], script.always_lines, applied, line, script.environments)
+                if failed is not None:
+                    results.put((k, script, line, "Always-required line {} failed in worker {}.".format(
+                        failed.idx, k)))
+                else:
+                    execute_line_unless(line, shells[k], False, False, script.sink(k), script.fingerprints,
+                                        script.durations)
+                    applied.add(line.idx)
+                    if line.always != "no" and (line.status == St.SUCCEEDED or line.always == "always-try"):
+                        script.environments.capture(line.idx, shells[k])
+                    results.put((k, script, line, None))
+                script.environments.release(line.idx)
+            except Exception as e:
+                script.environments.release(line.idx)
+                # the shell is started again for the next line
+                current = None
+                results.put((k, script, line, "Worker {} crashed: {}".format(k, e)))
+
+    def close(script):
+        # the script is done: final counts, state, and other executors may run it again
+        script.renderer.close()
+        if not script.journal.needs_lock:
+            lock(script.path, workeruid)
+        script.journal.compact(script.state, workeruid)
+        unlock(script.path, workeruid)
+        script.leases.stop()
+        script.environments.close()
+        script.done = True
+
+    def next_line(idle):
+        # (script, line) to execute, (None, None) if no script has a line ready
+        ready_shells = set([bound[k] for k in idle])
+        candidates = sorted([script for script in scripts if not script.done and not script.aborting],
+                            key=lambda script: (script.running, script not in ready_shells, script.served))
+        for script in candidates:
+            line = script.scheduler.pop()
+            if line is not None:
+                return script, line
+            if script.running == 0 and not script.scheduler.ready:
+                # nothing executing and no line waiting for the resources other scripts hold:
+                # nothing will be ready later either
+                close(script)
+        return None, None
+
+    threads = [threading.Thread(target=work, args=(k,)) for k in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for path in paths:
+            print("Going to EXECUTE script {} {}".format(path, args))
+            script = BatchScript(path, workeruid, backend)
+            script.leases.enable(path, workeruid, lease_s=lease, retries=retries)
+            if not lock(path, workeruid, timeout_s=1.):
+                print("Skipping {}: another executor is running it.".format(path))
+                script.leases.stop()
+                continue
+            scripts.append(script)
+            state = load_previous_if_exists(path, force_rerun=force_rerun, force_continue=cont, plain=True,
+                                            journal=script.journal, leases=script.leases)
+            if state is None:
+                unlock(path, workeruid)
+                script.leases.stop()
+                script.done = True
+                continue
+            script.fingerprints.enable(path, check=not force_rerun)
+            script.durations.enable(path)
+            script.journal.compact(state, workeruid)
+            if not script.journal.needs_lock:
+                unlock(path, workeruid)
+            script.state = state
+            script.always_lines = [line for line in state if line.always != "no"]
+            script.scheduler = Scheduler(state, script.durations.estimate, capacity, usage)
+            progress = Progress(path, start_t, script.durations.estimate, n_workers=jobs, metrics_dir=metrics)
+            script.renderer = Renderer(state, start_t, plain=True, quiet=quiet, label=script.label, progress=progress)
+            script.renderer.start()
+        idle = list(range(jobs))[::-1]
+        n_running = 0
+        served = 0
+        while True:
+            while idle:
+                script, line = next_line(idle)
+                if line is None:
+                    break
+                if is_noop(line.command):
+                    execute_line_unless(line, None, False, False, None, script.fingerprints, script.durations)
+                    changed = [line] + script.scheduler.finish(line)
+                    script.journal.append(changed, workeruid)
+                    script.renderer.update(changed)
+                    continue
+                # a shell already started for the script, or one not started yet, or any other
+                k = min(idle, key=lambda k: (bound[k] is not script, bound[k] is not None))
+                idle.remove(k)
+                line.start(workeruids[k])
+                script.journal.append([line], workeruid)
+                script.renderer.update([line])
+                served += 1
+                script.served = served
+                script.running += 1
+                n_running += 1
+                bound[k] = script
+                if line.always != "no":
+                    script.environments.begin(line.idx)
+                inboxes[k].put((script, line))
+            if n_running == 0:
+                break
+            k, script, line, error = results.get()
+            script.running -= 1
+            n_running -= 1
+            idle.append(k)
+            if error is not None:
+                bound[k] = None
+                script.renderer.message(error + " Aborting this script.")
+                line.requeue()
+                changed = [line]
+                script.aborting = True
+            else:
+                if line.status != St.SUCCEEDED and line.always == "always":
+                    script.renderer.message("Always-required command failed. Aborting this script.")
+                    script.aborting = True
+                changed = [line] + script.scheduler.finish(line)
+            script.journal.append(changed, workeruid)
+            script.renderer.update(changed)
+            if script.aborting and script.running == 0:
+                close(script)
+        for script in scripts:
+            if not script.done:
+                close(script)
+        print("")
+        print("DONE.")
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for script in scripts:
+            if not script.done:
+                release_executing_lines(script.path, script.journal, workeruid)
+                unlock(script.path, workeruid, strict=False)
+                script.leases.stop()
+                script.environments.close()
+        pool.close(shells)
+
+def sync_with_other_workers(journal, scheduler, renderer):
+    changed = journal.sync()
+    if changed is None:
+        scheduler.refresh(journal.state)
+        renderer.set_state(journal.state)
+    else:
+        skipped = []
+        for line in changed:
+            skipped.extend(scheduler.finish(line))
+        renderer.update(changed + skipped)
+    return journal.state
+
+def run_sequential(path, state, journal, workeruid, ishell, sink, parallel, interactive, renderer,
+                   capacity=None):
+    # single shell. In parallel mode, other processes work on the same state in the meantime
+    scheduler = Scheduler(state, durations.estimate if parallel else None, capacity)
+    while True:
+        line = scheduler.pop()
+        if line is None:
+            # nothing is ready. If not parallel, we are done.
+            if not parallel:
+                break
+            # But if parallel maybe we are waiting for another process to free some work branches
+            else:
+                if all_treated(state):
+                    break
+                else:
+                    renderer.message("Waiting for other processes to finish, or for resources.")
+                    with tracer.span("idle", workeruid):
+                        unlock(path, workeruid, strict=False)
+                        time.sleep(1)
+                    if journal.needs_lock:
+                        with tracer.span("lock", workeruid):
+                            lock(path, workeruid)
+                    with tracer.span("state", workeruid):
+                        state = sync_with_other_workers(journal, scheduler, renderer)
+                        # lines of workers which are gone would keep us waiting forever
+                        reclaimed = leases.reclaim(state)
+                        if reclaimed:
+                            renderer.message("Reclaimed lines {} from workers which are gone.".format(
+                                [line.idx for line in reclaimed]))
+                            changed = list(reclaimed)
+                            for line in reclaimed:
+                                changed.extend(scheduler.finish(line))
+                            journal.append(changed, workeruid)
+                            renderer.update(changed)
+                    continue
+        tracer.waits(line, scheduler, workeruid)
+        line.start(workeruid)
+        with tracer.span("state", workeruid, line.idx):
+            claimed = journal.claim(line, workeruid)
+            if not claimed: # another worker was faster
+                state = sync_with_other_workers(journal, scheduler, renderer)
+        if not claimed:
+            continue
+        if journal.needs_lock:
+            unlock(path, workeruid)
+        # update GUI
+        renderer.update([line])
+        # actually execute the line
+        with tracer.span("exec", workeruid, line.idx):
+            execute_line_unless(line, ishell, interactive, False, sink)
+        if journal.needs_lock:
+            with tracer.span("lock", workeruid, line.idx):
+                lock(path, workeruid)
+        with tracer.span("state", workeruid, line.idx):
+            if parallel:
+                # other processes may have changed state in the meantime
+                state = sync_with_other_workers(journal, scheduler, renderer)
+                to_mod_line = scheduler.lines[line.idx]
+                if to_mod_line is not line: # the state was reloaded
+                    to_mod_line.copy_exec_info(line)
+                    line = to_mod_line
+            skipped = scheduler.finish(line)
+            journal.append([line] + skipped, workeruid)
+        renderer.update([line] + skipped)
+        if line.status != St.SUCCEEDED and line.always == "always":
+            renderer.message("Always-required command failed. Aborting.")
+            break
+    return state
+
+def simulate(state, n_workers, estimate, capacity=None):
+    # discrete event simulation of a run of the state with n_workers shells, in which every line
+    # takes its estimate and succeeds. Like --jobs, workers run the "always" lines they missed.
+    # Returns the makespan and the busy time of each worker. The statuses of the state are restored
+    statuses = [line.status for line in state]
+    scheduler = Scheduler(state, estimate if n_workers > 1 else None, capacity)
+    always_lines = [line for line in state if line.always != "no"]
+    applied = [set() for _ in range(n_workers)]
+    busy = [0.] * n_workers
+    idle = list(range(n_workers))[::-1]
+    running = [] # (end, worker, idx)
+    now = 0.
+    while True:
+        while idle:
+            line = scheduler.pop()
+            if line is None:
+                break
+            if is_noop(line.command):
+                line.status = St.SUCCEEDED
+                scheduler.finish(line)
+                continue
+            k = idle.pop()
+            duration = estimate(line)
+            for prev in pending_always_lines(always_lines, applied[k], line):
+                duration += estimate(prev)
+                applied[k].add(prev.idx)
+            applied[k].add(line.idx)
+            line.status = St.EXECUTING
+            busy[k] += duration
+            heapq.heappush(running, (now + duration, k, line.idx))
+        if not running:
+            break
+        now, k, idx = heapq.heappop(running)
+        line = scheduler.lines[idx]
+        line.status = St.SUCCEEDED
+        scheduler.finish(line)
+        idle.append(k)
+    for line, status in zip(state, statuses):
+        line.status = status
+    return now, busy
+
+def critical_path(state, estimate):
+    # the longest chain of dependent lines: (estimated duration, idx of its lines)
+    scheduler = Scheduler(state)
+    paths = scheduler.critical_paths(state, estimate)
+    candidates = [line.idx for line in state if not line.dependencies and line.idx in paths]
+    if not candidates:
+        return 0., []
+    chain = [max(candidates, key=lambda idx: (paths[idx], -idx))]
+    while scheduler.dependents[chain[-1]]:
+        chain.append(max(scheduler.dependents[chain[-1]], key=lambda idx: (paths[idx], -idx)))
+    return paths[chain[0]], [idx for idx in chain if not is_noop(scheduler.lines[idx].command)]
+
+def format_duration(seconds):
+    if seconds < 60:
+        return "{:.1f}s".format(seconds)
+    return str(timedelta(seconds=round(seconds)))
+
+def print_simulation(path, max_workers, capacity=None):
+    # executor script.sh --simulate N: predicted wall time for 1 to N workers, without executing
+    # anything. Estimates come from the durations of previous runs
+    durations = Durations()
+    durations.enable(path)
+    known = set(durations.estimates)
+    if os.path.exists(path + ".executor"):
+        journal = Journal(path) if not os.path.exists(path + ".executor.db") else SqliteStore(path)
+        for line in journal.load() or []:
+            if line.command not in known and not is_noop(line.command) and line.starttime and line.endtime:
+                durations.update(line.command, (line.endtime - line.starttime).total_seconds())
+    state = initialize_state(path)
+    commands = [line for line in state if not is_noop(line.command)]
+    n_default = len([line for line in commands if line.command not in durations.estimates])
+    print("Simulating {}: {} commands, {} without a previous duration (estimated {:.1f}s each)".format(
+        path, len(commands), n_default, durations.default()))
+    print("")
+    print("workers  makespan   speedup  utilization")
+    sequential = None
+    for n_workers in range(1, max_workers + 1):
+        makespan, busy = simulate(state, n_workers, durations.estimate, capacity)
+        if sequential is None:
+            sequential = makespan
+        utilization = [b / makespan if makespan > 0 else 0. for b in busy]
+        if n_workers <= 8:
+            per_worker = " ".join(["{:.0%}".format(u) for u in utilization])
+        else:
+            per_worker = "min {:.0%} max {:.0%}".format(min(utilization), max(utilization))
+        print("{:>7}  {:>9}  {:>6.2f}x  {:>4.0%} ({})".format(
+            n_workers, format_duration(makespan), sequential / makespan if makespan > 0 else 1.,
+            sum(utilization) / n_workers, per_worker))
+    length, chain = critical_path(state, durations.estimate)
+    print("")
+    print("Critical path ({}): lines {}".format(format_duration(length),
+                                               " -> ".join([str(idx) for idx in chain])))
+
+class NoGC(object):
+    # creating millions of lines triggers the cyclic garbage collector over and over, for nothing
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            gc.enable()
+
+def hash_script(script):
+    return hashlib.sha1(script.encode()).hexdigest()
+
 def initialize_state(path):
+    with NoGC():
+        return parse_state(path)
+
+def parse_state(path):
     original_script = open(path, 'r').read()
     original_lines, corrected_lines = split_lines(original_script)
     state = [Line(idx+1, line, origline)
              for idx, (origline, line) in enumerate(zip(original_lines, corrected_lines))]
     assign_dependencies(state)
+    state = expand_foreach(state)
     detect_incompatible_commands(state)
     return state
 
@@ -337,37 +2095,426 @@ def make_dir_if_not_exists(dir_):
 def wid_to_str(wid):
     return "___".join([str(elem) for elem in wid])
 
-def lock(path, workeruid, timeout_s=10.):
-    lockfile = path + ".executor.lock"
-    retry_s = 0.5
-    waited_s = 0.
-    while timeout_s is None or waited_s < timeout_s:
-        if os.path.exists(lockfile):
-            time.sleep(retry_s)
-            continue
-        with open(lockfile, 'w') as f:
-            f.write(wid_to_str(workeruid))
+def is_remote_worker(wid):
+    # workers of executor serve are (pid, start time, host), see work(). Those of --jobs end with
+    # their number instead
+    return len(wid) == 3 and isinstance(wid[2], str)
+
+def wid_to_pid(widstr):
+    try:
+        return int(widstr.split("___")[0])
+    except ValueError:
+        return None
+
+def pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # exists, but belongs to another user
+        return True
+    return True
+
+class LockStats(object):
+    # time spent waiting for and holding the state lock, by this process
+    def __init__(self):
+        self.acquisitions = 0
+        self.wait_s = 0.
+        self.max_wait_s = 0.
+        self.hold_s = 0.
+        self.max_hold_s = 0.
+        self.stale = 0
+
+    def __repr__(self):
+        return "{} acquisitions, waited {:.3f}s (max {:.3f}s), held {:.3f}s (max {:.3f}s)".format(
+            self.acquisitions, self.wait_s, self.max_wait_s, self.hold_s, self.max_hold_s)
+
+lock_stats = LockStats()
+held_locks = {} # lockfile -> (fd, workeruid, acquisition time)
+
+class Span(object):
+    def __init__(self, tracer, name, worker, idx):
+        self.tracer = tracer
+        self.name = name
+        self.worker = worker
+        self.idx = idx
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.worker, self.start, time.time(), self.idx)
+
+class Tracer(object):
+    # timeline of what each worker spends its time on: waiting for dependencies, waiting for
+    # the lock, executing, writing the state. Spans are appended to a file per process
+    # (<script>.executor.trace.<pid>.jsonl), export_trace merges them. Disabled by default.
+    def __init__(self):
+        self.tpath = None
+        self.events = []
+        self.events_lock = threading.Lock()
+
+    def enable(self, path):
+        self.tpath = "{}.executor.trace.{}.jsonl".format(path, os.getpid())
+        # left by previous runs
+        for tpath, pid in trace_files(path):
+            if tpath != self.tpath and not pid_is_alive(pid):
+                os.remove(tpath)
+
+    def span(self, name, worker, idx=None):
+        return Span(self, name, worker, idx)
+
+    def record(self, name, worker, start, end, idx=None):
+        if self.tpath is None:
+            return
+        if not isinstance(worker, str):
+            worker = wid_to_str(worker)
+        with self.events_lock:
+            self.events.append({"name": name, "worker": worker, "pid": os.getpid(), "idx": idx,
+                                "start": start, "end": end})
+            if len(self.events) >= 1000:
+                self.flush_locked()
+
+    def waits(self, line, scheduler, worker):
+        # call when the line starts: from the start of the run until its dependencies were met,
+        # then until a worker picked it up
+        now = time.time()
+        ready = scheduler.ready_at.get(line.idx, now)
+        self.record("deps", worker, scheduler.start_t, ready, line.idx)
+        self.record("queued", worker, ready, now, line.idx)
+
+    def flush(self):
+        with self.events_lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.tpath is None or not self.events:
+            return
+        with open(self.tpath, 'a') as f:
+            f.write("".join([json.dumps(event) + "\n" for event in self.events]))
+        self.events = []
+
+tracer = Tracer()
+
+class Leases(object):
+    # a worker holds a lease on the lines it executes, renewed by heartbeats: a thread touches
+    # <script>.executor.heartbeat.<worker> every lease_s / 3. A line left executing by a worker
+    # whose process is gone, or whose last heartbeat is older than lease_s, can be reclaimed: it is
+    # executed again if it was not attempted more than 1 + retries times, otherwise it fails.
+    def __init__(self):
+        self.path = None
+        self.hpath = None
+        self.lease_s = 30.
+        self.retries = 1
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enable(self, path, workeruid, lease_s=30., retries=1):
+        self.path = path
+        self.lease_s = lease_s
+        self.retries = retries
+        self.hpath = self.heartbeat_path(workeruid)
+        # left by workers which died
+        directory, prefix = os.path.split(path + ".executor.heartbeat.")
+        for name in os.listdir(directory):
+            pid = wid_to_pid(name[len(prefix):]) if name.startswith(prefix) else None
+            if pid is not None and not pid_is_alive(pid):
+                os.remove(os.path.join(directory, name))
+        self.beat()
+        def run():
+            while not self.stopped.wait(self.lease_s / 3.):
+                self.beat()
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def heartbeat_path(self, workeruid):
+        # one per process, the workers of --jobs share it
+        return "{}.executor.heartbeat.{}".format(self.path, wid_to_str(workeruid[:2]))
+
+    def beat(self):
+        with open(self.hpath, 'a'):
+            pass
+        os.utime(self.hpath)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        os.remove(self.hpath)
+
+    def worker_is_alive(self, workeruid):
+        if is_remote_worker(workeruid):
+            # it sends heartbeats to the coordinator, which holds the lock as long as it serves: if
+            # we could read the state, the coordinator is gone, and the line would not be taken
+            # back from the worker by a new one (see Coordinator.worker_is_alive)
+            return False
+        if not pid_is_alive(workeruid[0]):
+            return False
+        try:
+            return time.time() - os.stat(self.heartbeat_path(workeruid)).st_mtime < self.lease_s
+        except FileNotFoundError: # executor <= 0.0.5 does not send heartbeats
             return True
-    print("Could not acquire lockfile {} after {}s".format(lockfile, waited_s))
+
+    def reclaim(self, state, worker_is_alive=None):
+        # returns the lines which were reclaimed
+        if self.path is None:
+            return []
+        if worker_is_alive is None:
+            worker_is_alive = self.worker_is_alive
+        reclaimed = []
+        for line in state:
+            if line.status != St.EXECUTING or not line.executedby:
+                continue
+            workeruid = line.executedby[-1]
+            if worker_is_alive(workeruid):
+                continue
+            if line.attempts <= self.retries:
+                line.status = St.UNTREATED
+            else:
+                line.status = St.FAILED
+                line.retcode = None
+                line.output = "Worker {} was lost while executing this line.".format(wid_to_str(workeruid))
+            reclaimed.append(line)
+        return reclaimed
+
+leases = Leases()
+
+def release_executing_lines(path, journal, workeruid):
+    # on the way out, the lines which this process was executing go back to untreated
+    if journal.state is None:
+        return
+    if path + ".executor.lock" not in held_locks:
+        lock(path, workeruid)
+    if journal.generation is not None:
+        journal.sync()
+    released = [line for line in journal.state if line.status == St.EXECUTING and line.executedby
+                and tuple(line.executedby[-1][:2]) == tuple(workeruid[:2])]
+    for line in released:
+        line.requeue()
+    if released:
+        journal.append(released, workeruid)
+        print("Lines {} were interrupted, they will execute again.".format([line.idx for line in released]))
+
+ASYNC_SPANS = ["deps", "queued"] # overlap with each other, one track per line
+
+def trace_files(path):
+    # [(path, pid)] of the per process traces of a script
+    directory, prefix = os.path.split(path + ".executor.trace.")
+    tpaths = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(".jsonl"):
+            pid = name[len(prefix):-len(".jsonl")]
+            if pid.isdigit():
+                tpaths.append((os.path.join(directory, name), int(pid)))
+    return tpaths
+
+def export_trace(path):
+    # merges the traces of all processes into <script>.executor.trace.json, in the chrome trace
+    # event format (chrome://tracing, ui.perfetto.dev), and <script>.executor.trace.csv
+    import csv
+    events = []
+    for tpath, _ in trace_files(path):
+        with open(tpath, 'r') as f:
+            for text in f:
+                try:
+                    events.append(json.loads(text))
+                except ValueError: # being written by another process
+                    pass
+    events.sort(key=lambda event: event["start"])
+    t0 = events[0]["start"] if events else 0.
+    trace_events = []
+    for event in events:
+        name = event["name"] if event["idx"] is None else "{} {}".format(event["name"], event["idx"])
+        common = {"name": name, "cat": event["name"], "pid": event["pid"], "tid": event["worker"],
+                  "args": {"line": event["idx"]}}
+        if event["name"] in ASYNC_SPANS:
+            trace_events.append(dict(common, ph="b", id=event["idx"], ts=(event["start"] - t0) * 1e6))
+            trace_events.append(dict(common, ph="e", id=event["idx"], ts=(event["end"] - t0) * 1e6))
+        else:
+            trace_events.append(dict(common, ph="X", ts=(event["start"] - t0) * 1e6,
+                                     dur=(event["end"] - event["start"]) * 1e6))
+    jpath = path + ".executor.trace.json"
+    with open(jpath, 'w') as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    with open(path + ".executor.trace.csv", 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["worker", "line", "span", "start", "duration_s"])
+        for event in events:
+            writer.writerow([event["worker"], event["idx"], event["name"],
+                             datetime.fromtimestamp(event["start"]).isoformat(),
+                             "{:.6f}".format(event["end"] - event["start"])])
+    return jpath
+
+def lock(path, workeruid, timeout_s=None):
+    # kernel advisory lock on the lockfile: waiters are woken up as soon as it is released, and
+    # the kernel releases it if the holder dies. The holder's id is written in the file.
+    lockfile = path + ".executor.lock"
+    start = time.time()
+    fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+    if timeout_s is None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    else:
+        retry_s = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                waited_s = time.time() - start
+                if waited_s >= timeout_s:
+                    holder = os.pread(fd, 1024, 0).decode()
+                    os.close(fd)
+                    print("Could not acquire lockfile {} after {:.1f}s (held by {})".format(
+                        lockfile, waited_s, holder))
+                    return False
+                time.sleep(retry_s)
+                retry_s = min(retry_s * 2, 0.05)
+    acquired = time.time()
+    # a clean unlock empties the file. If it is not, the previous holder died while holding it
+    previous_holder = os.pread(fd, 1024, 0).decode()
+    if previous_holder:
+        lock_stats.stale += 1
+        pid = wid_to_pid(previous_holder)
+        print("Recovered lockfile {} left by worker {} ({})".format(
+            lockfile, previous_holder,
+            "not running anymore" if pid is not None and not pid_is_alive(pid) else "status unknown"))
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, wid_to_str(workeruid).encode(), 0)
+    held_locks[lockfile] = (fd, workeruid, acquired)
+    lock_stats.acquisitions += 1
+    lock_stats.wait_s += acquired - start
+    lock_stats.max_wait_s = max(lock_stats.max_wait_s, acquired - start)
+    return True
 
 def unlock(path, workeruid, strict=True):
     lockfile = path + ".executor.lock"
-    if os.path.exists(lockfile):
-        with open(lockfile, 'r') as f:
-            file_workeruid = f.read()
-            if file_workeruid == wid_to_str(workeruid):
-                os.remove(lockfile)
-            else:
-                raise ValueError("unlocking lockfile {} which is locked by another worker {}".format(
-                    lockfile, file_workeruid))
+    if lockfile in held_locks:
+        fd, holder, acquired = held_locks[lockfile]
+        if holder != workeruid:
+            raise ValueError("unlocking lockfile {} which is locked by another worker {}".format(
+                lockfile, wid_to_str(holder)))
+        del held_locks[lockfile]
+        held_s = time.time() - acquired
+        lock_stats.hold_s += held_s
+        lock_stats.max_hold_s = max(lock_stats.max_hold_s, held_s)
+        os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
     else:
         if strict:
-            raise ValueError("unlocking lockfile {} which does not exist".format(lockfile))
+            raise ValueError("unlocking lockfile {} which is not locked by this process".format(lockfile))
         else:
             pass
 
+SNAPSHOT_PROTOCOL = 4 # the highest python 3.6 reads
+SNAPSHOT_EPOCH = datetime(1970, 1, 1) # times are naive: stored as seconds since a naive epoch
+SPARSE_DEFAULTS = {"dbginfo": None, "tag": None, "always": "no", "inputs": None, "outputs": None, "resources": None,
+                   "items": None, "source": None, "item": None, "attempts": 0}
+OUTPUT_PATH_FLAG = 0x80 # in the status column: the output is in the usual file
+UPTODATE_FLAG = 0x40
+
+def pack(values):
+    # the smallest integer array which holds the values, with None stored as the smallest value - 1
+    present = [value for value in values if value is not None]
+    none = min(present, default=1) - 1
+    top = max(present, default=0)
+    for typecode in "bhiq":
+        limit = 2 ** (8 * array(typecode).itemsize - 1)
+        if -limit <= none and top < limit:
+            break
+    if len(present) != len(values):
+        values = [none if value is None else value for value in values]
+    return none, array(typecode, values)
+
+def unpack(packed):
+    none, values = packed
+    return [None if value == none else value for value in values.tolist()]
+
+def encode_state(path, state):
+    # snapshots store the state by columns rather than as pickled Lines: numbers and statuses in
+    # arrays, dependencies and workers as per line counts and one array of values (CSR), workers
+    # interned, and the attributes which are rarely set only for the lines which have them
+    from operator import attrgetter
+    prefix = os.path.join(path + ".executor.out", "")
+    usual = [line.output_path is not None and line.output_path == "{}{}.log".format(prefix, line.idx)
+             for line in state]
+    workers = {}
+    nan = float("nan")
+    columns = {
+        "idx": pack([line.idx for line in state]),
+        "status": bytes([line.status.value | (OUTPUT_PATH_FLAG if is_usual else 0)
+                         | (UPTODATE_FLAG if line.uptodate else 0) for line, is_usual in zip(state, usual)]),
+        "retcode": pack([line.retcode for line in state]),
+        "output_bytes": pack([line.output_bytes for line in state]),
+        "log_offset": pack([line.log_offset for line in state]),
+        "starttime": array('d', [nan if line.starttime is None else (line.starttime - SNAPSHOT_EPOCH).total_seconds()
+                                 for line in state]),
+        "endtime": array('d', [nan if line.endtime is None else (line.endtime - SNAPSHOT_EPOCH).total_seconds()
+                               for line in state]),
+        "n_deps": pack([len(line.dependencies) for line in state]),
+        "deps": pack([dep for line in state for dep in line.dependencies]),
+        "n_workers": pack([len(line.executedby) for line in state]),
+        "worker_ids": pack([workers.setdefault(worker, len(workers)) for line in state for worker in line.executedby]),
+        "origtext": [line.origtext for line in state],
+        "output": [line.output for line in state],
+        "command": {pos: line.command for pos, line in enumerate(state) if line.command != line.origtext},
+        "output_path": {pos: line.output_path for pos, (line, is_usual) in enumerate(zip(state, usual))
+                        if line.output_path is not None and not is_usual},
+    }
+    for name, default in SPARSE_DEFAULTS.items():
+        columns[name] = {pos: value for pos, value in enumerate(map(attrgetter(name), state)) if value != default}
+    columns["workers"] = sorted(workers, key=workers.get)
+    return columns
+
+def decode_state(path, columns):
+    prefix = os.path.join(path + ".executor.out", "")
+    statuses = {st.value: st for st in St}
+    workers = columns["workers"]
+    deps = unpack(columns["deps"])
+    worker_ids = unpack(columns["worker_ids"])
+    state = []
+    n_dep = n_worker = 0
+    for (idx, origtext, status, retcode, output, output_bytes, log_offset, starttime, endtime, n_deps,
+         n_workers) in zip(unpack(columns["idx"]), columns["origtext"], columns["status"], unpack(columns["retcode"]),
+                           columns["output"], unpack(columns["output_bytes"]), unpack(columns["log_offset"]),
+                           columns["starttime"].tolist(), columns["endtime"].tolist(), unpack(columns["n_deps"]),
+                           unpack(columns["n_workers"])):
+        line = Line(idx, origtext, origtext)
+        line.status = statuses[status & 0x3f]
+        if status & OUTPUT_PATH_FLAG:
+            line.output_path = "{}{}.log".format(prefix, idx)
+        line.uptodate = bool(status & UPTODATE_FLAG)
+        line.retcode = retcode
+        line.output = output
+        line.output_bytes = output_bytes
+        line.log_offset = log_offset
+        if starttime == starttime: # not nan
+            line.starttime = SNAPSHOT_EPOCH + timedelta(seconds=starttime)
+        if endtime == endtime:
+            line.endtime = SNAPSHOT_EPOCH + timedelta(seconds=endtime)
+        if n_deps:
+            line.dependencies = deps[n_dep:n_dep + n_deps]
+            n_dep += n_deps
+        if n_workers:
+            line.executedby = [workers[k] for k in worker_ids[n_worker:n_worker + n_workers]]
+            n_worker += n_workers
+        state.append(line)
+    for name in ["command", "output_path"] + list(SPARSE_DEFAULTS):
+        for pos, value in columns.get(name, {}).items(): # snapshots of older versions lack some
+            setattr(state[pos], name, value)
+    shared = {} # the items of a foreach line share its dependencies
+    for line in state:
+        if line.source is not None:
+            dependencies = shared.setdefault(line.source, line.dependencies)
+            if dependencies == line.dependencies:
+                line.dependencies = dependencies
+    return state
 
-def write_state(path, state, workeruid, silent=False):
+def write_state(path, state, workeruid, silent=False, generation=0, script_hash=None):
     wpath = path + ".executor"
     make_dir_if_not_exists(os.path.dirname(wpath))
     if os.path.exists(wpath):
@@ -376,28 +2523,347 @@ def write_state(path, state, workeruid, silent=False):
     else:
         if not silent:
             print("Writing {}".format(wpath))
-    pickle.dump(state, open(wpath, 'wb'))
-
-    # write log
-    log = "\n".join([line.output for line in state if line.output is not None])
-    log = log + "\n" + datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    lpath = path + ".executor.{}.log".format(workeruid[0])
-    make_dir_if_not_exists(os.path.dirname(lpath))
-    if os.path.exists(lpath):
-        if not silent:
-            print("Overwriting {}".format(lpath))
-    else:
+    # readers must never see a half written state
+    with open(wpath + ".tmp", 'wb') as f:
+        pickle.dump({"generation": generation, "script_hash": script_hash, "columns": encode_state(path, state)}, f,
+                    protocol=SNAPSHOT_PROTOCOL)
+    os.replace(wpath + ".tmp", wpath)
+
+def read_state(path):
+    # returns the last snapshot: {"generation", "script_hash", "lines"}
+    with NoGC():
+        snapshot = pickle.load(open(path + ".executor", 'rb'))
+        if isinstance(snapshot, list): # written by executor <= 0.0.5
+            return {"generation": 0, "script_hash": None, "lines": snapshot}
+        if "columns" in snapshot:
+            snapshot["lines"] = decode_state(path, snapshot.pop("columns"))
+        return snapshot
+
+def to_timestamp(time_):
+    if time_ is None:
+        return None
+    return time_.timestamp()
+
+def from_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp)
+
+class Journal(object):
+    # the state is stored as the last snapshot (<script>.executor), followed by an append-only
+    # journal of line status transitions (<script>.executor.journal). The journal starts with the
+    # generation of the snapshot it applies to, compacting writes a new snapshot and a new journal.
+    # All methods are to be called while holding the lock.
+    needs_lock = True
+
+    def __init__(self, path, compact_every=1000):
+        self.path = path
+        self.jpath = path + ".executor.journal"
+        self.compact_every = compact_every
+        self.generation = None
+        self.script_hash = None # of the script the state was parsed from
+        self.offset = 0
+        self.n_records = 0
+        self.state = None
+        self.lines = {}
+
+    def load(self):
+        # snapshot + journal replay. Returns None if there is no previous state
+        if not os.path.exists(self.path + ".executor"):
+            return None
+        snapshot = read_state(self.path)
+        self.generation = snapshot["generation"]
+        self.script_hash = snapshot.get("script_hash")
+        self.set_state(snapshot["lines"])
+        self.offset = 0
+        self.n_records = 0
+        if self.read_generation() == self.generation:
+            self.replay()
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+        self.lines = {line.idx: line for line in state}
+
+    def read_generation(self):
+        # None if the journal does not exist
+        if not os.path.exists(self.jpath):
+            return None
+        with open(self.jpath, 'rb') as f:
+            header = f.readline()
+            self.offset = max(self.offset, len(header))
+        if not header.endswith(b"\n"):
+            return None
+        return json.loads(header.decode())["generation"]
+
+    def replay(self):
+        # apply the records written since the last read, returns the changed lines
+        changed = []
+        with open(self.jpath, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1 # a record is only complete once its newline is written
+        for record in data[:end].decode().splitlines():
+            record = json.loads(record)
+            line = self.lines[record["idx"]]
+            line.status = St[record["status"]]
+            line.retcode = record["retcode"]
+            line.output = record["output"]
+            line.output_bytes = record["output_bytes"]
+            line.output_path = record["output_path"]
+            line.log_offset = record["log_offset"]
+            line.starttime = from_timestamp(record["start"])
+            line.endtime = from_timestamp(record["end"])
+            line.attempts = record.get("attempts", line.attempts)
+            if record["worker"] is not None:
+                worker = tuple(record["worker"])
+                if worker not in line.executedby:
+                    line.executedby.append(worker)
+            changed.append(line)
+        self.offset += end
+        self.n_records += len(changed)
+        return changed
+
+    def sync(self):
+        # catch up with other workers. Returns the changed lines, or None if the whole state had to
+        # be reloaded because another worker compacted the journal
+        if self.read_generation() != self.generation:
+            self.load()
+            return None
+        return self.replay()
+
+    def claim(self, line, workeruid):
+        # line was just set to executing. The lock guarantees that nobody else claimed it
+        self.append([line], workeruid)
+        return True
+
+    def append(self, lines, workeruid):
+        records = []
+        for line in lines:
+            records.append(json.dumps({
+                "idx": line.idx,
+                "status": line.status.name,
+                "retcode": line.retcode,
+                "output": line.output,
+                "output_bytes": line.output_bytes,
+                "output_path": line.output_path,
+                "log_offset": line.log_offset,
+                "start": to_timestamp(line.starttime),
+                "end": to_timestamp(line.endtime),
+                "worker": line.executedby[-1] if line.executedby else None,
+                "attempts": line.attempts,
+            }) + "\n")
+        with open(self.jpath, 'r+b') as f:
+            # anything after what was read is an incomplete record, left by a worker which died
+            # while writing it
+            f.seek(self.offset)
+            f.truncate()
+            f.write("".join(records).encode())
+            self.offset = f.tell()
+        self.n_records += len(records)
+        if self.n_records >= max(self.compact_every, len(self.state)):
+            self.compact(self.state, workeruid)
+
+    def compact(self, state, workeruid, silent=True):
+        generation = (self.generation or 0) + 1
+        write_state(self.path, state, workeruid, silent=silent, generation=generation,
+                    script_hash=self.script_hash)
+        with open(self.jpath + ".tmp", 'wb') as f:
+            f.write((json.dumps({"generation": generation}) + "\n").encode())
+            self.offset = f.tell()
+        os.replace(self.jpath + ".tmp", self.jpath)
+        self.generation = generation
+        self.n_records = 0
+        self.set_state(state)
+
+class SqliteStore(object):
+    # alternative to Journal (--backend sqlite): the state lives in <script>.executor.db, one row
+    # per line, in WAL mode. Transitions are transactions, and claiming a line is a conditional
+    # update, so parallel workers only need the lock to load or replace the whole state. Readers
+    # never wait, e.g.
+    #   sqlite3 example.sh.executor.db "select status, count(*) from lines group by status"
+    needs_lock = False
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.dbpath = path + ".executor.db"
+        make_dir_if_not_exists(os.path.dirname(self.dbpath))
+        self.db = sqlite3.connect(self.dbpath, timeout=600, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lines (idx INTEGER PRIMARY KEY, line BLOB, "
+                        "status TEXT, retcode INTEGER, output TEXT, output_bytes INTEGER, output_path TEXT, "
+                        "log_offset INTEGER, starttime REAL, endtime REAL, workers TEXT, version INTEGER, "
+                        "attempts INTEGER DEFAULT 0)")
+        if "attempts" not in [row[1] for row in self.db.execute("PRAGMA table_info(lines)")]:
+            try: # database created before the column
+                self.db.execute("ALTER TABLE lines ADD COLUMN attempts INTEGER DEFAULT 0")
+            except sqlite3.OperationalError: # added by another worker in the meantime
+                pass
+        self.db.execute("CREATE INDEX IF NOT EXISTS lines_version ON lines (version)")
+        self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('clock', 0)")
+        self.generation = None
+        self.script_hash = None
+        self.state = None
+        self.lines = {}
+        self.seen = 0 # version of the last row read
+        self.own = set() # versions written by this worker, not read back
+        self.stored = {} # idx -> row, as last read or written
+
+    def meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def load(self):
+        self.generation = self.meta("generation")
+        if self.generation is None:
+            # switching from the default backend: start from its state
+            journal = Journal(self.path)
+            state = journal.load()
+            if state is not None:
+                self.script_hash = journal.script_hash
+                self.set_state(state)
+            return state
+        self.script_hash = self.meta("script_hash")
+        self.seen = self.meta("clock")
+        self.own = set()
+        self.stored = {}
+        state = []
+        with NoGC():
+            for row in self.db.execute("SELECT idx, line, " + self.COLUMNS + " FROM lines ORDER BY idx"):
+                line = pickle.loads(row[1])
+                self.apply(line, row[2:])
+                state.append(line)
+        self.set_state(in_script_order(state))
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+        self.lines = {line.idx: line for line in state}
+
+    COLUMNS = "status, retcode, output, output_bytes, output_path, log_offset, starttime, endtime, workers, attempts"
+
+    def row(self, line):
+        return (line.status.name, line.retcode, line.output, line.output_bytes, line.output_path,
+                line.log_offset, to_timestamp(line.starttime), to_timestamp(line.endtime),
+                json.dumps(line.executedby), line.attempts)
+
+    def apply(self, line, row):
+        line.status = St[row[0]]
+        line.retcode, line.output, line.output_bytes, line.output_path, line.log_offset = row[1:6]
+        line.starttime = from_timestamp(row[6])
+        line.endtime = from_timestamp(row[7])
+        line.executedby = [tuple(worker) for worker in json.loads(row[8])]
+        line.attempts = row[9]
+        self.stored[line.idx] = tuple(row)
+
+    def begin(self):
+        # write transaction, returns its version
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute("UPDATE meta SET value = value + 1 WHERE key = 'clock'")
+        version = self.meta("clock")
+        self.own.add(version)
+        return version
+
+    def sync(self):
+        # same as Journal.sync
+        if self.meta("generation") != self.generation:
+            self.load()
+            return None
+        changed = []
+        for row in self.db.execute("SELECT idx, version, " + self.COLUMNS + " FROM lines WHERE version > ? "
+                                   "ORDER BY version", (self.seen,)):
+            self.seen = max(self.seen, row[1])
+            if row[1] in self.own:
+                continue
+            line = self.lines[row[0]]
+            self.apply(line, row[2:])
+            changed.append(line)
+        self.own = set([version for version in self.own if version > self.seen])
+        return changed
+
+    def claim(self, line, workeruid):
+        # line was just set to executing. Fails if another worker claimed it since we last synced
+        version = self.begin()
+        try:
+            cursor = self.db.execute(
+                "UPDATE lines SET status = ?, retcode = ?, output = ?, output_bytes = ?, output_path = ?, "
+                "log_offset = ?, starttime = ?, endtime = ?, workers = ?, attempts = ?, version = ? "
+                "WHERE idx = ? AND (status = ? OR ?)",
+                self.row(line) + (version, line.idx, St.UNTREATED.name, line.always != "no"))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        if cursor.rowcount == 1:
+            self.stored[line.idx] = self.row(line)
+            return True
+        return False
+
+    def append(self, lines, workeruid):
+        if not lines:
+            return
+        version = self.begin()
+        try:
+            self.db.executemany(
+                "UPDATE lines SET status = ?, retcode = ?, output = ?, output_bytes = ?, output_path = ?, "
+                "log_offset = ?, starttime = ?, endtime = ?, workers = ?, attempts = ?, version = ? WHERE idx = ?",
+                [self.row(line) + (version, line.idx) for line in lines])
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        for line in lines:
+            self.stored[line.idx] = self.row(line)
+
+    def compact(self, state, workeruid, silent=True):
+        # stores the state. If it is the loaded one, only the lines which were changed in memory
+        # are written, otherwise the state is replaced (new generation)
+        if state is self.state and self.generation is not None:
+            self.append([line for line in state if self.row(line) != self.stored.get(line.idx)], workeruid)
+            return
         if not silent:
-            print("Writing {}".format(lpath))
-    open(lpath, 'w').write(log)
-
-def load_previous_if_exists(path, force_rerun=False, force_continue=False, parallel=False,
-                            reloading_in_mainloop=False):
-    new_state = initialize_state(path)
-    prev_path = path + ".executor"
-    if not os.path.exists(prev_path):
-        if reloading_in_mainloop:
-            raise ValueError("Previous state not found, but is required: {}".format(prev_path))
+            print("Writing {}".format(self.dbpath))
+        version = self.begin()
+        try:
+            self.db.execute("DELETE FROM lines")
+            self.db.executemany("INSERT INTO lines (idx, line, " + self.COLUMNS + ", version) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(line.idx, pickle.dumps(line)) + self.row(line) + (version,) for line in state])
+            generation = (self.generation or 0) + 1
+            self.db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                [("generation", generation), ("script_hash", self.script_hash)])
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.generation = generation
+        self.seen = version
+        self.own = set()
+        self.stored = {line.idx: self.row(line) for line in state}
+        self.set_state(state)
+
+def load_previous_if_exists(path, force_rerun=False, force_continue=False, parallel=False, plain=False,
+                            journal=None, leases=leases):
+    script_hash = hash_script(open(path, 'r').read())
+    if journal is None:
+        journal = Journal(path)
+    prev_state = journal.load()
+    if prev_state is not None:
+        reclaimed = leases.reclaim(prev_state)
+        if reclaimed:
+            print("Reclaimed lines {} from workers which are gone.".format([line.idx for line in reclaimed]))
+    if prev_state is None or journal.script_hash != script_hash:
+        # the script needs to be parsed
+        new_state = initialize_state(path)
+    if prev_state is not None and journal.script_hash is None: # written by executor <= 0.0.5
+        if states_have_same_original_files(new_state, prev_state):
+            journal.script_hash = script_hash
+    same_script = journal.script_hash == script_hash
+    journal.script_hash = script_hash # whichever state we return, it matches the current script
+    if prev_state is None:
         if force_continue:
             print("Warning: no previous execution file found, but --continue flag was specified.")
             print("Proceeding anyways in 3 seconds. (Ctrl-c to cancel)")
@@ -405,15 +2871,14 @@ def load_previous_if_exists(path, force_rerun=False, force_continue=False, paral
                 print("{}.".format(i))
                 time.sleep(1)
         return new_state
-    prev_state = pickle.load(open(prev_path, 'rb'))
-    if states_have_same_original_files(new_state, prev_state):
+    if same_script:
         # in parallel execution we are always continuing other workers work
-        if parallel or reloading_in_mainloop:
+        if parallel:
             return prev_state
         else:
             for line in prev_state:
                 if line.status == St.EXECUTING:
-                    pretty_print(prev_state)
+                    pretty_print(prev_state, plain=plain)
                     raise ValueError(
                         "Line {} is logged as executing. \
                          Either a parallel process is working on this script or \
@@ -444,33 +2909,195 @@ def load_previous_if_exists(path, force_rerun=False, force_continue=False, paral
         elif choice == 'f':
             for line in prev_state:
                 if line.status in [St.FAILED, St.SKIPPED]:
-                    line.status = St.UNTREATED
+                    line.requeue()
             print("Re-running failed then resuming")
             return prev_state
         elif choice == 'q':
             print("Aborting.")
         elif choice == 'a':
             print("Re-running all.")
-            return new_state
+            return initialize_state(path)
         elif choice == 'd':
-            pretty_print(prev_state)
-            return load_previous_if_exists(path)
+            pretty_print(prev_state, plain=plain)
+            return load_previous_if_exists(path, plain=plain, journal=journal, leases=leases)
         else:
             print("Unknown choice {}".format(choice))
         return None
     else:
         if parallel: # in parallel execution we are always continuing other workers work
-            raise ValueError("Script has changed, for --parallel this leads to undefined behavior. Aborting")
-        print("Previous state found for script, but script has changed.")
-        if force_rerun:
-            print("Forcing rerun.")
+            executing = [line.idx for line in prev_state if line.status == St.EXECUTING]
+            if executing:
+                raise ValueError("Script has changed while other workers execute lines {} of the previous "
+                                 "version, for --parallel this leads to undefined behavior. Aborting".format(
+                                     executing))
+            choice = 'm'
+        else:
+            print("Previous state found for script, but script has changed.")
+            if force_rerun:
+                print("Forcing rerun.")
+                return new_state
+            choice = 'm' if force_continue else input(
+                "Execute new script? [y/n, m: keep the results of unchanged lines]")
+        if choice.lower() == 'm':
+            kept = migrate_state(prev_state, new_state)
+            print("Script has changed: kept the results of {} unchanged lines, {} lines to execute.".format(
+                kept, len(new_state) - kept))
             return new_state
-        yn = input("Execute new script? [y/n]")
-        if yn.lower() in ['y', 'yes']:
+        if choice.lower() in ['y', 'yes']:
             return new_state
         else:
             exit
 
+def unique_anchors(a, a0, a1, b, b0, b1):
+    # pairs of positions of the texts which occur once in a[a0:a1] and once in b[b0:b1], the
+    # longest sequence of them which is in the same order on both sides (patience sorting)
+    counts = {}
+    for text in a[a0:a1]:
+        counts[text] = counts.get(text, 0) + 1
+    position = {}
+    for pos in range(b0, b1):
+        if counts.get(b[pos]) == 1:
+            position[b[pos]] = None if b[pos] in position else pos
+    candidates = [(pos, position[a[pos]]) for pos in range(a0, a1) if position.get(a[pos]) is not None]
+    tails = [] # tails[n]: smallest b position ending an increasing sequence of n + 1 candidates
+    tail_ends = []
+    previous = []
+    for n, (_, pos_b) in enumerate(candidates):
+        length = bisect.bisect_left(tails, pos_b)
+        previous.append(tail_ends[length - 1] if length else None)
+        if length == len(tails):
+            tails.append(pos_b)
+            tail_ends.append(n)
+        else:
+            tails[length] = pos_b
+            tail_ends[length] = n
+    anchors = []
+    n = tail_ends[-1] if tail_ends else None
+    while n is not None:
+        anchors.append(candidates[n])
+        n = previous[n]
+    return anchors[::-1]
+
+def shortest_edit_pairs(a, a0, a1, b, b0, b1, max_edits=1000):
+    # pairs of positions kept by the shortest edit script from a[a0:a1] to b[b0:b1] (Myers' O(ND)
+    # algorithm, fast when the two differ by few lines however repetitive they are). None are
+    # kept if it takes more than max_edits insertions and deletions
+    n = a1 - a0
+    m = b1 - b0
+    trace = [] # trace[d][k + d]: furthest x on diagonal k = x - y with d edits
+    for d in range(min(n + m, max_edits) + 1):
+        prev = trace[-1] if trace else None
+        furthest = [0] * (2 * d + 1)
+        for k in range(-d, d + 1, 2):
+            if d == 0:
+                x = 0
+            elif k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+                x = prev[k + 1 + d - 1] # insertion
+            else:
+                x = prev[k - 1 + d - 1] + 1 # deletion
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            furthest[k + d] = x
+            if x >= n and y >= m:
+                trace.append(furthest)
+                return backtrack_edits(trace, a0, b0, n, m)
+        trace.append(furthest)
+    return []
+
+def backtrack_edits(trace, a0, b0, x, y):
+    pairs = []
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+            prev_x = prev[k + 1 + d - 1]
+            prev_y = prev_x - k - 1
+            snake_x = prev_x
+        else:
+            prev_x = prev[k - 1 + d - 1]
+            prev_y = prev_x - k + 1
+            snake_x = prev_x + 1
+        while x > snake_x:
+            x -= 1
+            y -= 1
+            pairs.append((a0 + x, b0 + y))
+        x, y = prev_x, prev_y
+    while x > 0:
+        x -= 1
+        y -= 1
+        pairs.append((a0 + x, b0 + y))
+    return pairs
+
+def align_texts(a, b):
+    # pairs of positions (in a, in b) of the lines matched across an edit of the script (patience
+    # diff): the common beginning and end are matched, then the lines which are unique on both
+    # sides anchor the alignment, and what is between two anchors is aligned the same way. A
+    # stretch without any unique line is aligned by shortest_edit_pairs
+    pairs = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        a0, a1, b0, b1 = stack.pop()
+        while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+            pairs.append((a0, b0))
+            a0 += 1
+            b0 += 1
+        while a0 < a1 and b0 < b1 and a[a1 - 1] == b[b1 - 1]:
+            a1 -= 1
+            b1 -= 1
+            pairs.append((a1, b1))
+        if a0 == a1 or b0 == b1:
+            continue
+        anchors = unique_anchors(a, a0, a1, b, b0, b1)
+        if not anchors:
+            pairs.extend(shortest_edit_pairs(a, a0, a1, b, b0, b1))
+            continue
+        for anchor_a, anchor_b in anchors:
+            pairs.append((anchor_a, anchor_b))
+            stack.append((a0, anchor_a, b0, anchor_b))
+            a0, b0 = anchor_a + 1, anchor_b + 1
+        stack.append((a0, a1, b0, b1))
+    return pairs
+
+def migrate_state(prev_state, new_state):
+    # keeps the results of the lines which did not change across an edit of the script: the
+    # lines are aligned by text (see align_texts), a line which succeeded keeps its status
+    # if its dependencies are the same lines as before, and all of them were kept as well.
+    # Edited lines, and everything downstream of them, execute again. Returns the number of lines
+    # kept.
+    # (the items of a foreach line share its text)
+    prev_texts = [(line.origtext, line.item) for line in prev_state]
+    new_texts = [(line.origtext, line.item) for line in new_state]
+    pairs = align_texts(prev_texts, new_texts)
+    prev_of = {new_state[b].idx: prev_state[a] for a, b in pairs} # new idx -> previous line
+    kept = set()
+    moves = []
+    for line in new_state: # dependencies come before their dependents
+        prev = prev_of.get(line.idx)
+        if prev is None or prev.status != St.SUCCEEDED:
+            continue
+        if sorted([prev_of[dep].idx if dep in prev_of else None for dep in line.dependencies],
+                  key=str) != sorted(prev.dependencies, key=str):
+            continue
+        if not all([dep in kept for dep in line.dependencies]):
+            continue
+        line.carry_exec_info(prev)
+        kept.add(line.idx)
+        if line.output_path is not None and line.idx != prev.idx:
+            moves.append(line)
+    # per line output files are named after the line numbers: rename in two steps, as new names
+    # may be the old names of other lines
+    for line in moves:
+        if os.path.exists(line.output_path):
+            os.replace(line.output_path, line.output_path + ".migrating")
+    for line in moves:
+        output_path = os.path.join(os.path.dirname(line.output_path), "{}.log".format(line.idx))
+        if os.path.exists(line.output_path + ".migrating"):
+            os.replace(line.output_path + ".migrating", output_path)
+        line.output_path = output_path
+    return len(kept)
+
 def states_have_same_original_files(state1, state2):
     if len(state1) != len(state2):
         return False
@@ -480,7 +3107,8 @@ def states_have_same_original_files(state1, state2):
     return True
 
 def main(path="", args="", force_rerun=False, cont=False, parallel=False, interactive=False,
-         debug=False, version=False):
+         debug=False, version=False, jobs=1, plain=False, trace=False, lease=30., retries=1,
+         backend="journal", simulate=0, capacity="", quiet=False, metrics=""):
     if version:
         print_version()
         return
@@ -507,15 +3135,49 @@ def main(path="", args="", force_rerun=False, cont=False, parallel=False, intera
             # parallel assumes that we get failures / successes / skips info from other workers
             # force-rerun ignores that information by definition -> contradiction
             raise ValueError("Parallel execution is not supported with --force-rerun.")
-    path = os.path.abspath(path)
+    if jobs < 1:
+        raise ValueError("--jobs must be at least 1.")
+    if lease <= 0:
+        raise ValueError("--lease must be positive.")
+    if retries < 0:
+        raise ValueError("--retries must be at least 0.")
+    if backend not in ["journal", "sqlite"]:
+        raise ValueError("Unknown --backend {}, expected journal or sqlite.".format(backend))
+    if jobs > 1:
+        # the worker pool lives in this process, it does not share the state with other processes
+        if parallel:
+            raise ValueError("--jobs is not supported with --parallel.")
+        if interactive:
+            raise ValueError("--jobs is not supported with --interactive.")
+    # what the lines with a resources directive may use at the same time, on this machine
+    machine = machine_capacity()
+    machine.update(parse_resources(str(capacity).replace(",", " ").split()))
+    capacity = machine
+    paths = script_paths(path)
+    if not paths:
+        raise ValueError("No script found for {}.".format(path))
+    if simulate > 0:
+        for path in paths:
+            print_simulation(path, simulate, capacity)
+        return
+    if len(paths) > 1:
+        # one pool of shells for all the scripts
+        if parallel:
+            raise ValueError("--parallel is not supported with several scripts.")
+        if interactive:
+            raise ValueError("--interactive is not supported with several scripts.")
+        if trace:
+            raise ValueError("--trace is not supported with several scripts.")
+        run_batch(paths, args, workeruid, jobs, force_rerun=force_rerun, cont=cont, plain=plain, quiet=quiet,
+                  lease=lease, retries=retries, backend=backend, capacity=capacity, metrics=metrics)
+        return
+    path = paths[0]
     print("Going to EXECUTE script {} {}".format(path, args))
-    # spawn ishell
-    ishell = pexpect.spawn("/bin/bash")
-    ishell.logfile = open('/tmp/executor_running_log.{}.txt'.format(workeruid[0]), 'wb')
-    ishell.expect(r'\$')
-    if args != "":
-        ishell.sendline("set {}".format(args))
-        ishell.expect(r'\$')
+    # one shell per worker, they start in the background while the state is loaded
+    pool = ShellPool(args)
+    pool.warm(jobs)
+    sinks = [OutputSink(path, workeruid) for k in range(jobs)]
+    shells = []
     start_t = datetime.now()
     # atomic operation (transition from state to state)
     #   0. either execution of a line finishes, or we start from scratch
@@ -530,92 +3192,403 @@ def main(path="", args="", force_rerun=False, cont=False, parallel=False, intera
     #   3a. new state: line now executing / skipped
     #   3b. nothing to do: leave state as is
     #   4. write state - unlock
-    lock(path, workeruid)
+    if trace:
+        tracer.enable(path)
+    leases.enable(path, workeruid, lease_s=lease, retries=retries)
+    journal = SqliteStore(path) if backend == "sqlite" else Journal(path)
+    with tracer.span("lock", workeruid):
+        lock(path, workeruid)
     try:
-        state = load_previous_if_exists(path, force_rerun=force_rerun, force_continue=cont, parallel=parallel)
+        state = load_previous_if_exists(path, force_rerun=force_rerun, force_continue=cont, parallel=parallel,
+                                        plain=plain or quiet, journal=journal)
         if state is None:
             return
+        fingerprints.enable(path, check=not force_rerun)
+        durations.enable(path)
+        journal.compact(state, workeruid)
+        # interactive prompts can't be mixed with a redrawn display
+        progress = Progress(path, start_t, durations.estimate, n_workers=jobs, metrics_dir=metrics)
+        renderer = Renderer(state, start_t, workeruid=workeruid if jobs == 1 else None,
+                            plain=plain or interactive, quiet=quiet, progress=progress)
         if debug:
             for line in state:
                 print(line)
             input("Press enter to continue")
-        step = -1
-        while True:
-            step = step + 1
-            if step >= len(state):
-                # reached the end. If not parallel, we are done.
-                if not parallel:
-                    break
-                # But if parallel maybe we are waiting for another process to free some work branches
-                else:
-                    if all_treated(state):
-                        break
-                    else:
-                        print("Waiting for other processes to finish.")
-                        unlock(path, workeruid, strict=False)
-                        time.sleep(1)
-                        step = 0
-                        lock(path, workeruid)
-                        state = load_previous_if_exists(path, parallel=parallel, reloading_in_mainloop=True)
-                        continue
-            line = state[step]
-            skip = False
-            if line.always == "no": # "always" ignores dependencies
-                # skip lines if required (dependencies, or already done)
-                if line.status in [St.SKIPPED, St.EXECUTING, St.SUCCEEDED, St.FAILED]:
-                    continue
-                elif line.status in [St.UNTREATED]:
-                    leave_untreated = False
-                    for dep in line.dependencies:
-                        dep_status = find_line_with_idx(dep, state).status
-                        if dep_status in [St.EXECUTING]:
-                            leave_untreated = True # a sequential branch we can't do much about
-                        elif dep_status in [St.UNTREATED]:
-                            leave_untreated = True # we could also wait for the other process to free
-                        elif dep_status in [St.SKIPPED, St.FAILED]:
-                            skip = True
-                        elif dep_status in [St.SUCCEEDED]:
-                            pass
-                        else:
-                            raise ValueError("Unknown status {}".format(dep_status))
-                    if leave_untreated:
-                        continue
-                else:
-                    raise ValueError("Unknown status {}".format(line.status))
-            if skip:
-                line.status = St.SKIPPED
-            else:
-                line.status = St.EXECUTING
-                line.executedby.append(workeruid)
-            write_state(path, state, workeruid, silent=True)
+        shells = [pool.take(sink) for sink in sinks]
+        ishell = shells[0]
+        renderer.start()
+        if not journal.needs_lock:
+            # transitions are transactions, the lock is only needed to replace the state
             unlock(path, workeruid)
-            # update GUI (also if skipping)
-            print("EXECUTING ({})".format(datetime.now() - start_t))
-            print("---------")
-            pretty_print(state, workeruid=workeruid)
-            # actually execute the line
-            execute_line_unless(line, ishell, interactive, skip)
-            if line.status != St.SUCCEEDED and line.always == "always":
-                print("Always-required command failed. Aborting.")
-                break
-            # other processes may have changed state in the meantime
-            # load state again - change this line's status - then write state
+        try:
+            if jobs > 1:
+                workeruids = [workeruid + (k,) for k in range(jobs)]
+                state = run_jobs(path, state, journal, workeruids, shells, sinks, renderer, capacity)
+            else:
+                state = run_sequential(path, state, journal, workeruid, ishell, sinks[0], parallel, interactive,
+                                       renderer, capacity)
+        finally:
+            renderer.close()
+        if not journal.needs_lock:
             lock(path, workeruid)
-            state = load_previous_if_exists(path, parallel=parallel, reloading_in_mainloop=True)
-            to_mod_line = find_line_with_idx(line.idx, state)
-            to_mod_line.copy_exec_info(line) # maybe todo: check that line previous state was exec/skip
-            write_state(path, state, workeruid, silent=True)
-        print("EXECUTING ({})".format(datetime.now() - start_t))
-        print("---------")
-        pretty_print(state, workeruid=workeruid)
         print("")
         print("DONE.")
         print("")
         if DEBUG:
             globals().update(locals())
-        write_state(path, state, workeruid)
+        journal.compact(state, workeruid, silent=False)
+        if parallel:
+            print("Lock: {}".format(lock_stats))
+        if trace:
+            tracer.flush()
+            print("Trace: {}".format(export_trace(path)))
     finally:
-        # if I was executing a line, set it to untreated (or failed?), then write state
+        # if I was executing a line, set it to untreated, then write state
+        release_executing_lines(path, journal, workeruid)
         unlock(path, workeruid, strict=False)
-        ishell.logfile.close()
+        leases.stop()
+        tracer.flush()
+        pool.close(shells)
+
+# coordinator / workers: "executor serve script.sh" owns the state and hands out the lines which
+# are ready to "executor work host:port" processes, possibly on other machines, which run them in
+# their own shell. Messages are json, one per line, always sent by the worker:
+#   {"op": "hello"}                                  -> {"path", "args", "lease"}
+#   {"op": "next", "worker", "done", "outputs"}      -> {"line", "always", "fetch"} / {"wait"} / {"finished"}
+#   {"op": "heartbeat", "worker"}                    -> {}
+#   {"op": "release", "worker", "idx"}               -> {}
+#   {"op": "output", "idx"}                          -> {"output"} / {"pending"} / {"error"}
+# "done" is the result of the previous line. The full output of a line stays on the worker which
+# executed it, "fetch" asks for it, and it comes back in the "outputs" of the worker's next poll.
+
+def parse_address(address):
+    host, port = str(address).rsplit(":", 1)
+    return host, int(port)
+
+class Connection(object):
+    def __init__(self, address):
+        import socket
+        self.sock = socket.create_connection(parse_address(address))
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, message):
+        self.file.write((json.dumps(message) + "\n").encode())
+        self.file.flush()
+        reply = self.file.readline()
+        if not reply:
+            raise ConnectionError("connection closed by the coordinator")
+        return json.loads(reply.decode())
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+class Coordinator(object):
+    # the state and the scheduler behind "executor serve". Workers are identified by their
+    # workeruid (pid, start time, host), and are lost if they do not poll or send a heartbeat for
+    # lease_s seconds: their lines are reclaimed (see Leases)
+    def __init__(self, path, args, state, journal, renderer, workeruid, lease_s, capacity=None):
+        self.path = path
+        self.args = args
+        self.journal = journal
+        self.renderer = renderer
+        self.workeruid = workeruid
+        self.lease_s = lease_s
+        self.scheduler = Scheduler(state, durations.estimate, capacity)
+        self.always_lines = [line for line in state if line.always != "no"]
+        self.mutex = threading.Lock()
+        self.finished = threading.Event()
+        self.aborting = False
+        self.running = {} # idx -> worker
+        self.last_seen = {} # worker -> time
+        self.applied = {} # worker -> idx of the always lines its shell ran
+        self.fetch = {} # worker -> idx of the lines whose output was requested
+        self.outdir = path + ".executor.out"
+        make_dir_if_not_exists(self.outdir)
+
+    def handle(self, message):
+        with self.mutex:
+            op = message.get("op")
+            if op == "hello":
+                return {"path": self.path, "args": self.args, "lease": self.lease_s}
+            if op == "output":
+                return self.output(message["idx"])
+            worker = tuple(message["worker"])
+            self.last_seen[worker] = time.time()
+            if op == "heartbeat":
+                return {}
+            if op == "release":
+                line = self.scheduler.lines[message["idx"]]
+                if self.running.get(line.idx) == worker:
+                    del self.running[line.idx]
+                    line.requeue()
+                    self.scheduler.finish(line)
+                    self.journal.append([line], self.workeruid)
+                    self.renderer.update([line])
+                return {}
+            if op == "next":
+                for idx, output in message.get("outputs", {}).items():
+                    self.store_output(self.scheduler.lines[int(idx)], output)
+                if message.get("done") is not None:
+                    self.done(worker, message["done"])
+                return self.next(worker)
+            return {"error": "unknown op {}".format(op)}
+
+    def worker_is_alive(self, worker):
+        return time.time() - self.last_seen.get(worker, 0.) < self.lease_s
+
+    def release_running(self):
+        # on the way out, the lines the workers are executing go back to untreated
+        with self.mutex:
+            released = [self.scheduler.lines[idx] for idx in sorted(self.running)]
+            self.running = {}
+            for line in released:
+                line.requeue()
+            if released:
+                self.journal.append(released, self.workeruid)
+        return released
+
+    def done(self, worker, result):
+        line = self.scheduler.lines[result["idx"]]
+        if self.running.get(line.idx) != worker: # reclaimed in the meantime
+            return
+        del self.running[line.idx]
+        if result.get("error") is not None:
+            self.renderer.message(result["error"] + " Aborting.")
+            line.requeue()
+            self.journal.append([line], self.workeruid)
+            self.renderer.update([line])
+            self.aborting = True
+            return
+        self.applied.setdefault(worker, set()).add(line.idx)
+        line.status = St[result["status"]]
+        line.retcode = result["retcode"]
+        line.output = result["output"]
+        line.output_bytes = result["output_bytes"]
+        line.output_path = None # on the worker, until fetched
+        line.starttime = from_timestamp(result["start"])
+        line.endtime = from_timestamp(result["end"])
+        durations.record(line)
+        if line.status != St.SUCCEEDED and line.always == "always":
+            self.renderer.message("Always-required command failed. Aborting.")
+            self.aborting = True
+        changed = [line] + self.scheduler.finish(line)
+        self.journal.append(changed, self.workeruid)
+        self.renderer.update(changed)
+
+    def next(self, worker):
+        reclaimed = leases.reclaim([self.scheduler.lines[idx] for idx in self.running], self.worker_is_alive)
+        if reclaimed:
+            self.renderer.message("Reclaimed lines {} from workers which are gone.".format(
+                [line.idx for line in reclaimed]))
+            changed = list(reclaimed)
+            for line in reclaimed:
+                del self.running[line.idx]
+                changed.extend(self.scheduler.finish(line))
+            self.journal.append(changed, self.workeruid)
+            self.renderer.update(changed)
+        fetch = sorted(self.fetch.pop(worker, set()))
+        while not self.aborting:
+            line = self.scheduler.pop()
+            if line is None:
+                break
+            if is_noop(line.command):
+                execute_line_unless(line, None, False, False)
+                changed = [line] + self.scheduler.finish(line)
+                self.journal.append(changed, self.workeruid)
+                self.renderer.update(changed)
+                continue
+            line.start(worker)
+            self.running[line.idx] = worker
+            self.journal.append([line], self.workeruid)
+            self.renderer.update([line])
+            applied = self.applied.setdefault(worker, set())
+            always = pending_always_lines(self.always_lines, applied, line)
+            applied.update([prev.idx for prev in always])
+            return {"line": [line.idx, line.command, line.always],
+                    "always": [[prev.idx, prev.command, prev.always] for prev in always], "fetch": fetch}
+        if not self.running:
+            self.finished.set()
+            return {"finished": True, "fetch": fetch}
+        return {"wait": 0.5, "fetch": fetch}
+
+    def store_output(self, line, output):
+        line.output_path = os.path.join(self.outdir, "{}.log".format(line.idx))
+        with open(line.output_path, 'w') as f:
+            f.write(output)
+        self.journal.append([line], self.workeruid)
+
+    def output(self, idx):
+        line = self.scheduler.lines.get(idx)
+        if line is None:
+            return {"error": "line {} does not exist".format(idx)}
+        if line.output_path is not None and os.path.exists(line.output_path):
+            with open(line.output_path, 'r') as f:
+                return {"output": f.read()}
+        if line.status in [St.SUCCEEDED, St.FAILED] and line.executedby:
+            worker = line.executedby[-1]
+            if self.worker_is_alive(worker):
+                self.fetch.setdefault(worker, set()).add(idx)
+                return {"pending": True}
+        return {"error": "the output of line {} is not available".format(idx)}
+
+def serve(path, host="127.0.0.1", port=7777, args="", force_rerun=False, cont=False, plain=False, lease=30.,
+          retries=1, capacity="", quiet=False, metrics=""):
+    # executor serve script.sh: owns the state of the script and hands out its lines to workers.
+    # The workers may run on several machines: capacity, if given, is for all of them together
+    capacity = parse_resources(str(capacity).replace(",", " ").split()) or None
+    import socketserver
+    workeruid = (os.getpid(), time.time())
+    path = os.path.abspath(path)
+    print("Serving script {} {} on {}:{}".format(path, args, host, port))
+    # the coordinator is the only one writing the state
+    if not lock(path, workeruid, timeout_s=1.):
+        raise ValueError("Another executor is working on {}.".format(path))
+    journal = Journal(path)
+    coordinator = None
+    try:
+        leases.enable(path, workeruid, lease_s=lease, retries=retries)
+        state = load_previous_if_exists(path, force_rerun=force_rerun, force_continue=cont, plain=plain or quiet,
+                                        journal=journal)
+        if state is None:
+            return
+        durations.enable(path)
+        journal.compact(state, workeruid)
+        start_t = datetime.now()
+        progress = Progress(path, start_t, durations.estimate, metrics_dir=metrics)
+        renderer = Renderer(state, start_t, plain=plain, quiet=quiet, progress=progress)
+        coordinator = Coordinator(path, args, state, journal, renderer, workeruid, lease, capacity)
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for request in self.rfile:
+                    reply = coordinator.handle(json.loads(request.decode()))
+                    self.wfile.write((json.dumps(reply) + "\n").encode())
+                    self.wfile.flush()
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        renderer.start()
+        try:
+            coordinator.finished.wait()
+            # let the workers which are polling learn that we are done
+            time.sleep(1.)
+        finally:
+            server.shutdown()
+            server.server_close()
+            renderer.close()
+        print("")
+        print("DONE.")
+        print("")
+        journal.compact(state, workeruid, silent=False)
+    finally:
+        if coordinator is not None:
+            released = coordinator.release_running()
+            if released:
+                print("Lines {} were interrupted, they will execute again.".format([line.idx for line in released]))
+        release_executing_lines(path, journal, workeruid)
+        unlock(path, workeruid, strict=False)
+        leases.stop()
+
+def work(address):
+    # executor work host:port: executes lines for a coordinator, in the current directory
+    import socket
+    import tempfile
+    workeruid = (os.getpid(), time.time(), socket.gethostname())
+    connection = Connection(address)
+    hello = connection.request({"op": "hello"})
+    print("Working on {} for {}".format(hello["path"], address))
+    # outputs are kept here, until the coordinator asks for them or the worker exits
+    directory = tempfile.mkdtemp(prefix="executor_worker_")
+    local_path = os.path.join(directory, os.path.basename(hello["path"]))
+    sink = OutputSink(local_path, workeruid)
+    ishell = spawn_shell(hello["args"], sink)
+    stopped = threading.Event()
+
+    def heartbeat():
+        beats = Connection(address)
+        try:
+            while not stopped.wait(hello["lease"] / 3.):
+                beats.request({"op": "heartbeat", "worker": workeruid})
+        except (OSError, ValueError):
+            pass
+        finally:
+            beats.close()
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+    start_t = datetime.now()
+    done = None
+    outputs = {}
+    line = None
+    try:
+        while True:
+            reply = connection.request({"op": "next", "worker": workeruid, "done": done, "outputs": outputs})
+            done = None
+            outputs = {}
+            for idx in reply.get("fetch", []):
+                opath = os.path.join(sink.outdir, "{}.log".format(idx))
+                if os.path.exists(opath):
+                    with open(opath, 'rb') as f:
+                        outputs[idx] = f.read().decode(errors='replace')
+                else:
+                    outputs[idx] = ""
+            if reply.get("finished"):
+                if outputs: # deliver what was asked for on the way out
+                    connection.request({"op": "next", "worker": workeruid, "done": None, "outputs": outputs})
+                break
+            if "wait" in reply:
+                time.sleep(reply["wait"])
+                continue
+            error = None
+            for idx, command, always in reply["always"]:
+                retcode, _ = execute_line(Line(idx, command, command), ishell)
+                if retcode != 0 and always == "always":
+                    error = "Always-required line {} failed in worker {}.".format(idx, wid_to_str(workeruid))
+                    break
+            idx, command, always = reply["line"]
+            line = Line(idx, command, command)
+            line.always = always
+            if error is None:
+                execute_line_unless(line, ishell, False, False, sink)
+            print("[{}] {} {:>3} {}".format(str(datetime.now() - start_t).split(".")[0], as_symbol(line.status),
+                                             idx, command))
+            done = {"idx": idx, "status": line.status.name, "retcode": line.retcode, "output": line.output,
+                    "output_bytes": line.output_bytes, "start": to_timestamp(line.starttime),
+                    "end": to_timestamp(line.endtime), "error": error}
+            line = None
+    except (OSError, ValueError) as e:
+        print("Lost the coordinator: {}".format(e))
+    finally:
+        stopped.set()
+        if line is not None: # interrupted: give it back
+            try:
+                connection.request({"op": "release", "worker": workeruid, "idx": line.idx})
+            except (OSError, ValueError):
+                pass
+        connection.close()
         ishell.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    print("DONE.")
+
+def fetch(address, line):
+    # executor fetch host:port LINE: prints the full output of a line, from the worker which ran it
+    connection = Connection(address)
+    try:
+        for _ in range(600):
+            reply = connection.request({"op": "output", "idx": int(line)})
+            if "output" in reply:
+                sys.stdout.write(reply["output"])
+                return
+            if "error" in reply:
+                raise ValueError(reply["error"])
+            time.sleep(0.1)
+        raise ValueError("The output of line {} did not arrive, is its worker busy?".format(line))
+    finally:
+        connection.close()
+
+COMMANDS = {"serve": serve, "work": work, "fetch": fetch}
@@ -0,0 +1,47 @@
+import exectr
+
+
+def line(idx, command, inputs=None, outputs=None):
+    line = exectr.Line(idx, command, command)
+    line.inputs = inputs
+    line.outputs = outputs
+    return line
+
+
+def succeed(fingerprints, line):
+    fingerprint, uptodate = fingerprints.check(line)
+    assert not uptodate
+    fingerprints.record(line, fingerprint)
+
+
+def test_same_command_with_different_inputs(tmpdir):
+    tmpdir.chdir()
+    path = str(tmpdir.join("s.sh"))
+    tmpdir.join("in1").write("1")
+    tmpdir.join("in2").write("2")
+    tmpdir.join("out").write("")
+    lines = [line(1, "cat in? > out", inputs=["in1"], outputs=["out"]),
+             line(2, "cat in? > out", inputs=["in2"], outputs=["out"])]
+    fingerprints = exectr.Fingerprints()
+    fingerprints.enable(path)
+    for each in lines:
+        succeed(fingerprints, each)
+    fingerprints = exectr.Fingerprints()
+    fingerprints.enable(path)
+    assert [fingerprints.check(each)[1] for each in lines] == [True, True]
+
+
+def test_foreach_items_which_only_use_the_variable_in_their_outputs(tmpdir):
+    tmpdir.chdir()
+    path = str(tmpdir.join("s.sh"))
+    tmpdir.join("s.sh").write("# executor foreach n in 1..2\n# executor outputs out$n\n./generate\n")
+    items = [each for each in exectr.initialize_state(path) if each.item is not None]
+    assert [each.command for each in items] == ["./generate", "./generate"]
+    fingerprints = exectr.Fingerprints()
+    fingerprints.enable(path)
+    for each in items:
+        succeed(fingerprints, each)
+    tmpdir.join("out1").write("")
+    tmpdir.join("out2").write("")
+    # neither overwrote the fingerprint of the other
+    assert [fingerprints.check(each)[1] for each in items] == [True, True]
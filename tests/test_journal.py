@@ -0,0 +1,84 @@
+import exectr
+from exectr import St
+
+WORKER = (1, 0.)
+
+
+def new_journal(tmpdir, n_lines=10, compact_every=1000):
+    path = str(tmpdir.join("s.sh"))
+    with open(path, "w") as f:
+        f.write("".join(["echo {}\n".format(k) for k in range(n_lines)]))
+    journal = exectr.Journal(path, compact_every=compact_every)
+    journal.compact(exectr.initialize_state(path), WORKER)
+    return path, journal
+
+
+def finish(journal, idx, status=St.SUCCEEDED):
+    line = journal.lines[idx]
+    line.start(WORKER)
+    journal.claim(line, WORKER)
+    line.status = status
+    line.retcode = 0 if status == St.SUCCEEDED else 1
+    line.output = "output of {}".format(idx)
+    journal.append([line], WORKER)
+
+
+def statuses(state):
+    return {line.idx: line.status for line in state}
+
+
+def test_replay(tmpdir):
+    path, journal = new_journal(tmpdir)
+    finish(journal, 1)
+    finish(journal, 2, St.FAILED)
+    state = exectr.Journal(path).load()
+    assert statuses(state)[1] == St.SUCCEEDED
+    assert statuses(state)[2] == St.FAILED
+    assert statuses(state)[3] == St.UNTREATED
+    assert state[0].output == "output of 1"
+    assert state[0].executedby == [WORKER]
+    assert state[0].attempts == 1
+
+
+def test_compaction_keeps_the_state(tmpdir):
+    path, journal = new_journal(tmpdir, compact_every=4)
+    reader = exectr.Journal(path)
+    reader.load()
+    for idx in range(1, 9):
+        finish(journal, idx)
+    assert journal.generation > 1 # compacted along the way
+    assert journal.n_records < len(journal.state) # compacts once there are as many records as lines
+    # a worker which read an older generation reloads everything
+    assert reader.sync() is None
+    assert statuses(reader.state) == statuses(journal.state)
+    state = exectr.Journal(path).load()
+    assert [line.idx for line in state if line.status == St.SUCCEEDED] == list(range(1, 9))
+
+
+def test_crash_partway_through_an_append(tmpdir):
+    path, journal = new_journal(tmpdir)
+    finish(journal, 1)
+    with open(path + ".executor.journal", "ab") as f: # a worker died while writing this record
+        f.write(b'{"idx": 2, "status": "SUCCEEDED", "retc')
+    journal = exectr.Journal(path)
+    state = journal.load()
+    assert statuses(state)[1] == St.SUCCEEDED
+    assert statuses(state)[2] == St.UNTREATED
+    # the next record replaces the incomplete one
+    finish(journal, 3)
+    state = exectr.Journal(path).load()
+    assert statuses(state)[2] == St.UNTREATED
+    assert statuses(state)[3] == St.SUCCEEDED
+    with open(path + ".executor.journal", "rb") as f:
+        assert b'"retc{' not in f.read() # not followed by the next record
+
+
+def test_other_workers_catch_up(tmpdir):
+    path, journal = new_journal(tmpdir)
+    reader = exectr.Journal(path)
+    reader.load()
+    finish(journal, 1)
+    changed = reader.sync()
+    assert [line.idx for line in changed] == [1, 1] # executing, then succeeded
+    assert statuses(reader.state)[1] == St.SUCCEEDED
+    assert reader.sync() == []
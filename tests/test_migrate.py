@@ -0,0 +1,100 @@
+import os
+import time
+
+import exectr
+from exectr import St
+
+
+def parse(tmpdir, name, lines):
+    # the empty line after the last newline is a line as well
+    path = str(tmpdir.join(name))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return exectr.initialize_state(path)
+
+
+def succeeded(state):
+    for line in state:
+        line.status = St.SUCCEEDED
+        line.retcode = 0
+        line.output = "output of {}".format(line.idx)
+    return state
+
+
+def test_unchanged_lines_keep_their_status(tmpdir):
+    prev = succeeded(parse(tmpdir, "a.sh", ["echo a", "echo b", "echo c"]))
+    new = parse(tmpdir, "b.sh", ["echo a", "echo inserted", "echo b", "echo c"])
+    assert exectr.migrate_state(prev, new) == 4
+    assert [line.status for line in new][:4] == [St.SUCCEEDED, St.UNTREATED, St.SUCCEEDED, St.SUCCEEDED]
+    assert new[2].output == "output of 2"
+
+
+def test_edited_line_executes_again_with_its_dependents(tmpdir):
+    lines = ["# executor set-dependent", "echo a", "echo b", "echo c", "# executor set-independent", "echo d"]
+    prev = succeeded(parse(tmpdir, "a.sh", lines))
+    lines[2] = "echo B"
+    new = parse(tmpdir, "b.sh", lines)
+    exectr.migrate_state(prev, new)
+    status = {line.command: line.status for line in new}
+    assert status["echo a"] == St.SUCCEEDED
+    assert status["echo B"] == St.UNTREATED
+    assert status["echo c"] == St.UNTREATED # depends on the edited line
+    assert status["echo d"] == St.SUCCEEDED
+
+
+def test_failed_lines_are_not_kept(tmpdir):
+    prev = succeeded(parse(tmpdir, "a.sh", ["echo a", "false"]))
+    prev[1].status = St.FAILED
+    new = parse(tmpdir, "b.sh", ["echo a", "false", "echo b"])
+    assert exectr.migrate_state(prev, new) == 2
+    assert new[1].status == St.UNTREATED
+
+
+def test_outputs_follow_lines_which_moved(tmpdir):
+    prev = succeeded(parse(tmpdir, "a.sh", ["echo a", "echo b"]))
+    outdir = str(tmpdir.join("a.sh.executor.out"))
+    os.makedirs(outdir)
+    for line in prev:
+        line.output_path = os.path.join(outdir, "{}.log".format(line.idx))
+        with open(line.output_path, "w") as f:
+            f.write(line.command)
+    new = parse(tmpdir, "b.sh", ["echo first", "echo a", "echo b"])
+    exectr.migrate_state(prev, new)
+    for line in new[1:]:
+        assert line.output_path == os.path.join(outdir, "{}.log".format(line.idx))
+        with open(line.output_path) as f:
+            assert f.read() == line.command
+
+
+def test_repetitive_large_script(tmpdir):
+    # few distinct commands: a diff which ignores frequent lines (difflib's autojunk) would keep
+    # almost nothing
+    lines = ["echo {}".format(i % 10) for i in range(20000)]
+    prev = succeeded(parse(tmpdir, "a.sh", lines))
+    new = parse(tmpdir, "b.sh", lines[:1000] + ["echo inserted"] + lines[1000:19000] + ["echo also inserted"]
+                + lines[19000:])
+    start = time.time()
+    assert exectr.migrate_state(prev, new) == 20001
+    assert time.time() - start < 10.
+    assert [line.command for line in new if line.status == St.UNTREATED] == ["echo inserted", "echo also inserted"]
+
+
+def test_repeated_lines_between_unique_ones(tmpdir):
+    lines = []
+    for block in range(50):
+        lines.append("cd block{}".format(block))
+        lines.extend(["make"] * 40)
+    prev = succeeded(parse(tmpdir, "a.sh", lines))
+    edited = list(lines)
+    del edited[500]
+    edited.insert(1500, "make")
+    new = parse(tmpdir, "b.sh", edited)
+    assert exectr.migrate_state(prev, new) == len(lines)
+
+
+def test_align_texts_matches_equal_texts_in_order():
+    a = list("abcabba") * 30
+    b = list("cbabac") * 30
+    pairs = sorted(exectr.align_texts(a, b))
+    assert all([a[i] == b[j] for i, j in pairs])
+    assert all([p[0] < q[0] and p[1] < q[1] for p, q in zip(pairs, pairs[1:])])
@@ -0,0 +1,129 @@
+import os
+import random
+import sys
+
+import pytest
+
+import exectr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import bench_overhead  # noqa
+
+
+def assign_dependencies_quadratic(state):
+    # assign_dependencies as it was before the single pass: every directive scans the state
+    def after(idx):
+        return [line for line in state if line.idx > idx]
+
+    def find_tag(tag, before):
+        for line in state:
+            if line.idx == before:
+                break
+            if line.tag == tag:
+                return line
+        return None
+
+    for line in state:
+        if not exectr.is_comment(line.command):
+            continue
+        line.dbginfo = "Comment"
+        nextline = ([other for other in state if other.idx == line.idx + 1] or [None])[0]
+        args = line.command.strip(" #").split(" ")
+        if not args or args.pop(0) != "executor":
+            continue
+        directive = args.pop(0)
+        if nextline is None:
+            break
+        if directive == "set-dependent":
+            for predecessor, dependent in zip(after(line.idx), after(line.idx + 1)):
+                dependent.dependencies.append(predecessor.idx)
+        elif directive == "set-independent":
+            for dependent in after(line.idx):
+                dependent.dependencies = []
+        elif directive in ["always", "always-try"]:
+            nextline.always = directive
+        elif directive == "if":
+            tag = args.pop(0)
+            try:
+                condition = int(tag)
+            except ValueError:
+                target = find_tag(tag, line.idx)
+                if target is None:
+                    raise ValueError("if directive: tag not found: {}".format(line.command))
+                condition = target.idx
+            nextline.dependencies.append(condition)
+        elif directive == "tag":
+            tag = args.pop(0)
+            if find_tag(tag, line.idx) is not None:
+                raise ValueError("tag directive: tag already exists: {}".format(line.command))
+            nextline.tag = tag
+
+
+def summary(state):
+    return [(line.idx, line.command, sorted(set(line.dependencies)), line.tag, line.always) for line in state]
+
+
+def both(path):
+    with open(path) as f:
+        original_lines, corrected_lines = exectr.split_lines(f.read())
+    reference = [exectr.Line(idx + 1, line, origline)
+                 for idx, (origline, line) in enumerate(zip(original_lines, corrected_lines))]
+    try:
+        assign_dependencies_quadratic(reference)
+    except ValueError:
+        reference = "error"
+    try:
+        state = exectr.initialize_state(path)
+    except ValueError:
+        state = "error"
+    return (reference if reference == "error" else summary(reference),
+            state if state == "error" else summary(state))
+
+
+@pytest.mark.parametrize("topology", bench_overhead.TOPOLOGIES)
+def test_single_pass_matches_quadratic_on_benchmark_topologies(tmpdir, topology):
+    path = str(tmpdir.join("s.sh"))
+    bench_overhead.generate_script(path, topology, 2000)
+    reference, state = both(path)
+    assert state == reference
+
+
+def random_script(rng, n):
+    lines = []
+    tags = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.1:
+            lines.append("# executor set-dependent")
+        elif r < 0.17:
+            lines.append("# executor set-independent")
+        elif r < 0.22:
+            lines.append("# executor always")
+        elif r < 0.3:
+            tag = "t{}".format(rng.randint(0, 30)) # now and then twice, which is an error
+            tags.append(tag)
+            lines.append("# executor tag " + tag)
+        elif r < 0.38 and tags:
+            lines.append("# executor if " + rng.choice(tags))
+        elif r < 0.42:
+            lines.append("# executor if {}".format(rng.randint(1, i + 1)))
+        elif r < 0.46:
+            lines.append("# a comment")
+        elif r < 0.5:
+            lines.append("")
+        elif r < 0.53:
+            lines.append("echo continued \\")
+        else:
+            lines.append("echo {}".format(i))
+    lines.append("echo end")
+    return "\n".join(lines)
+
+
+def test_single_pass_matches_quadratic_on_random_scripts(tmpdir):
+    rng = random.Random(0)
+    path = str(tmpdir.join("s.sh"))
+    for _ in range(300):
+        with open(path, "w") as f:
+            f.write(random_script(rng, rng.randint(3, 60)))
+        reference, state = both(path)
+        assert state == reference
@@ -0,0 +1,73 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import exectr
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start(tmpdir, code):
+    env = dict(os.environ, PYTHONPATH=REPO, HOME=str(tmpdir))
+    return subprocess.Popen([sys.executable, "-c", "import exectr; " + code], cwd=str(tmpdir),
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+
+
+def statuses(path):
+    return {line.idx: line.status for line in exectr.Journal(path).load() or []}
+
+
+def wait_for(condition, timeout_s=20.):
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        if condition():
+            return
+        time.sleep(0.1)
+    raise AssertionError("timed out")
+
+
+@pytest.mark.parametrize("sig", [signal.SIGINT, signal.SIGKILL])
+def test_restart_after_coordinator_stopped_with_line_in_flight(tmpdir, sig):
+    # the coordinator goes away while a worker executes line 1: a new coordinator executes it again
+    path = str(tmpdir.join("s.sh"))
+    with open(path, "w") as f:
+        f.write("sleep $(cat delay)\necho done\n")
+    tmpdir.join("delay").write("30")
+    port = free_port()
+    serve = "exectr.serve({!r}, port={}, quiet=True, cont=True)".format(path, port)
+    work = "exectr.work('127.0.0.1:{}')".format(port)
+    processes = [start(tmpdir, serve)]
+    try:
+        wait_for(lambda: os.path.exists(path + ".executor.journal"))
+        processes.append(start(tmpdir, work))
+        wait_for(lambda: statuses(path).get(1) == exectr.St.EXECUTING)
+        processes[0].send_signal(sig)
+        processes[0].wait(timeout=20)
+        if sig == signal.SIGINT: # given back on the way out
+            assert statuses(path)[1] == exectr.St.UNTREATED
+        else: # left executing by a remote worker, whose pid is alive on this host
+            assert statuses(path)[1] == exectr.St.EXECUTING
+        # the worker is still executing the line when the new coordinator starts
+        tmpdir.join("delay").write("0")
+        coordinator = start(tmpdir, serve)
+        processes.append(coordinator)
+        wait_for(lambda: statuses(path).get(1) != exectr.St.EXECUTING or coordinator.poll() is not None)
+        processes.append(start(tmpdir, work))
+        assert coordinator.wait(timeout=30) == 0
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+    assert set(statuses(path).values()) == {exectr.St.SUCCEEDED}